@@ -0,0 +1,328 @@
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import jsonio
+from homography import perspective_transforms
+from image_pool import ImagePool
+from page_cache import PageCache, decode_page, display_mode
+from saver import atomic_write_json
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'JPG', 'JPEG', 'PNG']
+INDEX_NAME = '.checkdata_index.json'
+INDEX_VERSION = 1
+# kind of the "coords" of a textline: four points or an "x y w h" string
+KIND_QUAD, KIND_RECT, KIND_UNKNOWN = 0, 1, 2
+# used by the AccountFiles created outside of an Account
+DEFAULT_IMAGE_POOL = ImagePool()
+
+
+def scan_images(acc_dir: Path) -> List[Path]:
+    """Every image under `acc_dir`, grouped by extension in IMAGE_EXTENSIONS order and sorted within a group."""
+    groups: Dict[str, List[Path]] = {ext: [] for ext in IMAGE_EXTENSIONS}
+    for root, _, files in os.walk(acc_dir):
+        for name in files:
+            ext = name.rsplit('.', 1)[-1]
+            if '.' in name and ext in groups:
+                groups[ext].append(Path(root, name))
+    return sum((sorted(groups[ext]) for ext in IMAGE_EXTENSIONS), [])
+
+
+def parse_coords(textlines: List[dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """Kind of every textline and its coordinates normalized into an (N, 4, 2) array.
+
+    Quads keep their four points, rects are stored as their top-left corner and (w, h).
+    """
+    kinds = np.full(len(textlines), KIND_UNKNOWN, dtype=np.uint8)
+    coords = np.zeros((len(textlines), 4, 2), dtype=np.float64)
+    for i, obj in enumerate(textlines):
+        points = obj['coords']
+        if isinstance(points, list):
+            kinds[i] = KIND_QUAD
+            coords[i] = np.reshape(points, (4, 2))
+        elif isinstance(points, str):
+            kinds[i] = KIND_RECT
+            coords[i, :2] = np.reshape([int(item) for item in points.strip().split()], (2, 2))
+    return kinds, coords
+
+
+def crop_array(array: np.ndarray, x: int, y: int, w: int, h: int) -> np.ndarray:
+    """Copy of a rectangle of a page, zero-filled outside of the page like `Image.crop`."""
+    page_h, page_w = array.shape[:2]
+    if x >= 0 and y >= 0 and x + w <= page_w and y + h <= page_h:
+        return np.array(array[y:y + h, x:x + w])
+    out = np.zeros((h, w) + array.shape[2:], dtype=array.dtype)
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, page_w), min(y + h, page_h)
+    if x1 > x0 and y1 > y0:
+        out[y0 - y:y1 - y, x0 - x:x1 - x] = array[y0:y1, x0:x1]
+    return out
+
+
+class Account():
+    """Textline files under a directory, indexed without opening them.
+
+    The index (image mtime, sidecar mtime/size and line count per image) is cached in
+    `INDEX_NAME` inside the account directory and refreshed at startup by stat-ing only;
+    a sidecar is parsed again only when it changed. AccountFiles are created on first access.
+    """
+    def __init__(self, acc_dir: Path, index_path: Optional[Path] = None, page_cache: Optional[PageCache] = None,
+                 image_pool: Optional[ImagePool] = None):
+        self.acc_dir = Path(acc_dir)
+        self.page_cache = page_cache
+        self.image_pool = image_pool if image_pool is not None else ImagePool()
+        self.index_path = Path(index_path) if index_path is not None else self.acc_dir / INDEX_NAME
+        self.entries = self.load_index()
+        self.file_entries = [entry for entry in self.entries if entry['lines'] > 0]
+        self.acc_images = [self.acc_dir / entry['image'] for entry in self.file_entries]
+        self.acc_jsons = [image.with_suffix('.json') for image in self.acc_images]
+        self.line_counts = [entry['lines'] for entry in self.file_entries]
+        self.accs: Dict[int, AccountFile] = {}
+        # files are created on first access, from the GUI thread as well as from the crop threads
+        self._accs_lock = threading.Lock()
+
+    def select_files(self, indices: List[int]):
+        """Keep only the files at `indices`, in that order. Files are then numbered by their new position."""
+        self.file_entries = [self.file_entries[idx] for idx in indices]
+        self.acc_images = [self.acc_images[idx] for idx in indices]
+        self.acc_jsons = [self.acc_jsons[idx] for idx in indices]
+        self.line_counts = [self.line_counts[idx] for idx in indices]
+        self.accs = {}
+
+    def load_index(self) -> List[dict]:
+        cached = {}
+        if self.index_path.exists():
+            try:
+                index = jsonio.load(self.index_path)
+                if index.get('version') == INDEX_VERSION:
+                    cached = {entry['image']: entry for entry in index['files']}
+            except (ValueError, KeyError) as e:
+                print(f'Ignore broken index {self.index_path}: {e}')
+
+        entries = []
+        changed = False
+        for image_path in scan_images(self.acc_dir):
+            rel_path = image_path.relative_to(self.acc_dir).as_posix()
+            entry = self.stat_entry(image_path, rel_path, cached.get(rel_path))
+            changed = changed or entry is not cached.get(rel_path)
+            entries.append(entry)
+        changed = changed or len(entries) != len(cached)
+
+        if changed:
+            try:
+                atomic_write_json(self.index_path, {'version': INDEX_VERSION, 'files': entries})
+            except OSError as e:
+                print(f'Could not write index {self.index_path}: {e}')
+        return entries
+
+    @staticmethod
+    def stat_entry(image_path: Path, rel_path: str, cached: Optional[dict]) -> dict:
+        """Index entry of an image, reusing `cached` when neither the image nor its sidecar changed."""
+        json_path = image_path.with_suffix('.json')
+        image_mtime = image_path.stat().st_mtime_ns
+        try:
+            json_stat = json_path.stat()
+            json_mtime, json_size = json_stat.st_mtime_ns, json_stat.st_size
+        except FileNotFoundError:
+            json_mtime, json_size = None, None
+
+        if (cached is not None and cached['image_mtime'] == image_mtime
+                and cached['json_mtime'] == json_mtime and cached['json_size'] == json_size):
+            return cached
+
+        lines = 0
+        if json_mtime is not None:
+            try:
+                lines = len(jsonio.load(json_path))
+            except ValueError as e:
+                print(f'Skip {json_path}: {e}')
+        return {
+            'image': rel_path,
+            'image_mtime': image_mtime,
+            'json_mtime': json_mtime,
+            'json_size': json_size,
+            'lines': lines,
+        }
+
+    def line_count(self, idx) -> int:
+        """Number of textlines of a file, without loading it if it has not been visited yet."""
+        if idx in self.accs:
+            return len(self.accs[idx])
+        return self.line_counts[idx]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        acc_file = self.accs.get(idx)
+        if acc_file is None:
+            with self._accs_lock:
+                acc_file = self.accs.get(idx)
+                if acc_file is None:
+                    acc_file = AccountFile(self.acc_images[idx], self.acc_jsons[idx], self.page_cache,
+                                           self.image_pool)
+                    self.accs[idx] = acc_file
+        return acc_file
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __len__(self):
+        return len(self.acc_images)
+
+
+class AccountFile():
+    def __init__(self, image_path: Path, json_path: Path, page_cache: Optional[PageCache] = None,
+                 image_pool: Optional[ImagePool] = None):
+        self.image_path = image_path
+        self.json_path = json_path
+        self.page_cache = page_cache
+        # decoded pages are borrowed from a bounded pool instead of being kept for the lifetime of the file
+        self.image_pool = image_pool if image_pool is not None else DEFAULT_IMAGE_POOL
+
+        self.textlines = jsonio.load(json_path)
+        for obj in self.textlines:
+            # identical texts across lines and files share a single string
+            obj['predict_text'] = sys.intern(obj['predict_text'])
+            obj['labling_text'] = sys.intern(obj['labling_text'])
+        self.kinds, self.coords = parse_coords(self.textlines)
+        for i in np.flatnonzero(self.kinds == KIND_UNKNOWN):
+            print(f'Unknow type of "coords" in {json_path}, line {i}')
+        self.check_flags = np.zeros(len(self.textlines), dtype=np.uint8)
+        # pages are loaded on demand and crops may be requested from prefetch threads
+        self.image_lock = threading.Lock()
+        self._sizes: Optional[np.ndarray] = None
+        self._transforms: Optional[np.ndarray] = None
+
+    def set_flag(self, idx, value) -> bool:
+        """Set the check flag of a textline, return whether it changed."""
+        if self.check_flags[idx] == value:
+            return False
+        self.check_flags[idx] = value
+        return True
+
+    def unchecked_count(self) -> int:
+        return int(np.count_nonzero(self.check_flags == 0))
+
+    def incorrect_textlines(self):
+        return [self.textlines[i] for i in np.flatnonzero(self.check_flags == 0)]
+
+    @property
+    def array(self) -> np.ndarray:
+        """The page decoded once into a NumPy array."""
+        return self.level_array(0)
+
+    def level_array(self, level: int) -> np.ndarray:
+        """The page at a pyramid level (downscaled by 2 ** level), memory-mapped from the page cache if any."""
+        if self.page_cache is None and level > 0:
+            raise ValueError('Pyramid levels need a page cache')
+        with self.image_lock:
+            return self.image_pool.get((self.image_path, level), lambda: self._load_level(level))
+
+    def _load_level(self, level: int) -> np.ndarray:
+        if self.page_cache is not None:
+            return self.page_cache.get(self.image_path, level)
+        return decode_page(self.image_path)
+
+    def geometry(self):
+        """Crop size (width, height) of every textline and the homographies of the quadrilateral ones.
+
+        Computed once for the whole file; textlines with an empty crop get a size of zero.
+        """
+        with self.image_lock:
+            if self._sizes is None:
+                self._sizes, self._transforms = self._compute_geometry()
+            return self._sizes, self._transforms
+
+    def _compute_geometry(self):
+        sizes = np.zeros((len(self.textlines), 2), dtype=np.int64)
+        transforms = np.full((len(self.textlines), 3, 3), np.nan)
+        rects = self.kinds == KIND_RECT
+        sizes[rects] = np.maximum(self.coords[rects, 1], 0)
+
+        quad_indices = np.flatnonzero(self.kinds == KIND_QUAD)
+        if len(quad_indices) == 0:
+            return sizes, transforms
+        quads = self.coords[quad_indices]
+
+        def side(a, b):
+            return np.linalg.norm(quads[:, a] - quads[:, b], axis=1)
+
+        widths = np.rint((side(0, 1) + side(2, 3)) / 2).astype(np.int64)
+        heights = np.rint((side(0, 3) + side(1, 2)) / 2).astype(np.int64)
+
+        non_empty = widths * heights > 0
+        dst = np.zeros((len(quads), 4, 2))
+        dst[:, [1, 2], 0] = widths[:, None]
+        dst[:, [2, 3], 1] = heights[:, None]
+        M, ok = perspective_transforms(quads[non_empty], dst[non_empty])
+
+        solved = quad_indices[non_empty][ok]
+        sizes[solved, 0] = widths[non_empty][ok]
+        sizes[solved, 1] = heights[non_empty][ok]
+        transforms[solved] = M[ok]
+        return sizes, transforms
+
+    def valid_indices(self) -> np.ndarray:
+        """Indices of the textlines whose crop is not empty."""
+        sizes, _ = self.geometry()
+        return np.flatnonzero(sizes.min(axis=1) > 0)
+
+    def crop(self, idx, level: int = 0) -> Image.Image:
+        """Crop a textline, from a downscaled page (and then downscaled as much) when level > 0."""
+        sizes, _ = self.geometry()
+        width, height = (int(v) for v in sizes[idx])
+        kind = self.kinds[idx]
+
+        if kind != KIND_UNKNOWN and width * height == 0:
+            with Image.open(self.image_path) as image:
+                return Image.new(display_mode(image), (width, height))
+        # cut from the pooled page array, so that a page is only pooled once
+        return Image.fromarray(self.crop_pixels(idx, level))
+
+    def crop_pixels(self, idx, level: int = 0) -> np.ndarray:
+        """Same as `crop` but returns the pixels as an array, cut straight from the decoded page."""
+        sizes, transforms = self.geometry()
+        width, height = (int(v) for v in sizes[idx])
+        kind = self.kinds[idx]
+        scale = 2 ** level
+        page = self.level_array(level)
+
+        if kind == KIND_QUAD:
+            if width * height == 0:
+                return np.zeros((height, width) + page.shape[2:], dtype=page.dtype)
+            M = transforms[idx]
+            if level > 0:
+                M = np.diag([1 / scale, 1 / scale, 1.]) @ M @ np.diag([scale, scale, 1.])
+            size = (max(1, width // scale), max(1, height // scale))
+            return cv2.warpPerspective(page, M, size)
+        elif kind == KIND_RECT:
+            x, y = (int(v) for v in self.coords[idx, 0])
+            return crop_array(page, x // scale, y // scale, max(1, width // scale), max(1, height // scale))
+        print('Unknow type of "coords"')
+        exit(-1)
+
+    def crops(self, indices=None) -> List[Tuple[int, Image.Image]]:
+        """Crop many textlines at once, skipping the empty ones. Defaults to every textline."""
+        valid = self.valid_indices()
+        if indices is not None:
+            valid = np.intersect1d(valid, indices)
+        return [(int(idx), self.crop(idx)) for idx in valid]
+
+    def texts(self, idx):
+        obj = self.textlines[idx]
+        return obj['predict_text'].strip(), obj['labling_text'].strip()
+
+    def __getitem__(self, idx):
+        predict_text, labling_text = self.texts(idx)
+        return self.crop(idx), predict_text, labling_text
+
+    def __len__(self):
+        return len(self.textlines)
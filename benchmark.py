@@ -0,0 +1,229 @@
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import cv2
+import numpy as np
+
+from account import INDEX_NAME, Account
+from duplicate_region import Annotation, MappingPlan, load_region_config, run
+from saver import JsonSaver
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def parse_size(text: str):
+    width, height = [int(item) for item in text.lower().split('x')]
+    return width, height
+
+
+def box(x, y, w, h):
+    return [[x, y], [x + w, y], [x + w, y + h], [x, y + h]]
+
+
+def make_page(rng: np.random.Generator, page_size) -> np.ndarray:
+    width, height = page_size
+    # cheap to generate but still costly to encode/decode like a real scan
+    page = np.full((height, width, 3), 235, dtype=np.uint8)
+    noise = rng.integers(0, 40, size=(height // 8 + 1, width // 8 + 1), dtype=np.uint8)
+    page -= cv2.resize(noise, (width, height), interpolation=cv2.INTER_NEAREST)[..., None]
+    return page
+
+
+def generate_account(out_dir: Path, files: int, lines: int, page_size, coords: str, seed: int = 0):
+    """Write `files` pages with `lines` textlines each, coords being 'quad', 'rect' or 'mixed'."""
+    rng = np.random.default_rng(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    width, height = page_size
+    line_h = max(8, height // (lines + 1))
+    for i in range(files):
+        image_path = out_dir / f'{i // 1000:03d}' / f'page_{i:06d}.jpg'
+        image_path.parent.mkdir(exist_ok=True)
+        cv2.imwrite(str(image_path), make_page(rng, page_size))
+        textlines = []
+        for j in range(lines):
+            x = int(rng.integers(0, width // 4))
+            w = int(rng.integers(width // 4, width - x))
+            y, h = j * line_h, int(line_h * 0.8)
+            quad = coords == 'quad' or (coords == 'mixed' and j % 2 == 0)
+            if quad:
+                skew = float(rng.uniform(-3, 3))
+                points = [[x, y + skew], [x + w, y - skew], [x + w, y + h - skew], [x, y + h + skew]]
+            else:
+                points = f'{x} {y} {w} {h}'
+            text = f'line {j} of page {i}'
+            textlines.append({'coords': points, 'predict_text': text, 'labling_text': text})
+        json.dump(textlines, open(image_path.with_suffix('.json'), 'wt', encoding='utf8'), ensure_ascii=False)
+
+
+def generate_labelme(out_dir: Path, files: int, shapes: int, page_size, region_config: dict, seed: int = 0):
+    """Write a reference annotation and `files` targets holding only perturbed copies of its regions."""
+    rng = np.random.default_rng(seed)
+    (out_dir / 'targets').mkdir(parents=True, exist_ok=True)
+    width, height = page_size
+    names = region_config['names']
+    cols = int(np.ceil(np.sqrt(len(names))))
+    cell_w, cell_h = width / cols, height / cols
+    regions = {}
+    for k, name in enumerate(names):
+        x, y = (k % cols) * cell_w, (k // cols) * cell_h
+        regions[name] = box(x + 5, y + 5, cell_w - 10, cell_h - 10)
+    childs = []
+    for k in range(shapes):
+        x, y = np.array(regions[names[k % len(names)]]).min(axis=0).tolist()
+        childs.append((f'TXT{k % 7}', box(x + rng.uniform(0, cell_w - 60), y + rng.uniform(0, cell_h - 30), 40, 15)))
+
+    def labelme(image_path, labeled_points):
+        return {
+            'version': '4.5.6', 'flags': {}, 'imageData': None,
+            'imagePath': image_path, 'imageHeight': height, 'imageWidth': width,
+            'shapes': [{'label': label, 'points': points, 'group_id': None, 'shape_type': 'polygon', 'flags': {}}
+                       for label, points in labeled_points],
+        }
+
+    ref_json = out_dir / 'ref.json'
+    json.dump(labelme('ref.jpg', list(regions.items()) + childs), open(ref_json, 'wt'), indent=4)
+    for i in range(files):
+        moved = [(name, (np.array(points) + rng.normal(0, 4, (4, 2)) + rng.normal(0, 20, 2)).tolist())
+                 for name, points in regions.items()]
+        json.dump(labelme(f'frame_{i:06d}.jpg', moved), open(out_dir / 'targets' / f'frame_{i:06d}.json', 'wt'),
+                  indent=4)
+    return ref_json
+
+
+def workers_peak_mb() -> Optional[float]:
+    """Largest peak RSS of the worker processes that exited so far, where the platform reports it."""
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2**10
+
+
+def measure(name: str, fn: Callable, items: int, unit: str, setup: Optional[Callable] = None) -> dict:
+    """Time `fn`, then run it again under tracemalloc for its peak memory, `setup` being called before each run.
+
+    Tracing slows allocations down, so the time comes from the untraced run. tracemalloc only sees
+    this process, the memory of worker processes is their peak RSS, given when one of them outgrew
+    the workers of the previous measures.
+    """
+    workers_before = workers_peak_mb()
+    if setup is not None:
+        setup()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    workers_peak = workers_peak_mb()
+    result = {
+        'name': name,
+        'seconds': seconds,
+        'items': items,
+        'throughput': items / seconds if seconds > 0 else float('inf'),
+        'unit': unit,
+        'peak_mb': peak / 2**20,
+        'workers_peak_mb': workers_peak if workers_peak != workers_before else None,
+    }
+    message = f'{name:<24} {seconds:8.3f}s {result["throughput"]:10.1f} {unit}/s   peak {result["peak_mb"]:8.1f}MB'
+    if result['workers_peak_mb']:
+        message += f'   workers peak RSS {result["workers_peak_mb"]:8.1f}MB'
+    print(message)
+    return result
+
+
+def bench_account(acc_dir: Path, files: int, lines: int) -> List[dict]:
+    results = []
+    results.append(measure('index cold start', lambda: Account(acc_dir), files, 'files',
+                           setup=lambda: (acc_dir / INDEX_NAME).unlink(missing_ok=True)))
+    results.append(measure('index warm start', lambda: Account(acc_dir), files, 'files'))
+
+    # a new Account for each run, so that no page is already decoded
+    accounts: List[Account] = []
+
+    def crop_all():
+        for acc_file in accounts[-1]:
+            acc_file.crops()
+    results.append(measure('crop extraction', crop_all, files * lines, 'lines',
+                           setup=lambda: accounts.append(Account(acc_dir))))
+    account = accounts[-1]
+
+    def save_all():
+        saver = JsonSaver()
+        for acc_file in account:
+            for idx in range(0, len(acc_file), 2):
+                acc_file.set_flag(idx, 1)
+            saver.submit(acc_file.json_path, acc_file.incorrect_textlines())
+        saver.close()
+    results.append(measure('save', save_all, files, 'files'))
+    return results
+
+
+def bench_duplicate_region(labelme_dir: Path, ref_json: Path, region_config: dict, files: int,
+                           workers: int) -> List[dict]:
+    anno_ref = Annotation.parse_from_labelme(ref_json)
+    json_paths = sorted((labelme_dir / 'targets').glob('*.json'))
+    # files are rewritten in place, each run starts from the generated ones
+    originals = {json_path: json_path.read_bytes() for json_path in json_paths}
+
+    def restore():
+        for json_path, data in originals.items():
+            json_path.write_bytes(data)
+
+    def duplicate():
+        plan = MappingPlan(anno_ref, region_config)
+        run(json_paths, plan, workers)
+    return [measure(f'region duplication x{workers}', duplicate, files, 'files', setup=restore)]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Time the data paths of checkdata on a synthetic dataset')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Empty directory where to generate data, a temporary dir by default')
+    parser.add_argument('--keep', action='store_true', help='Do not delete the generated data')
+    parser.add_argument('--files', type=int, default=50, help='Number of pages / labelme files')
+    parser.add_argument('--lines', type=int, default=30, help='Textlines per page')
+    parser.add_argument('--shapes', type=int, default=200, help='Shapes in the labelme reference')
+    parser.add_argument('--page-size', type=parse_size, default=(2480, 3508), help='WIDTHxHEIGHT of a page')
+    parser.add_argument('--coords', choices=['quad', 'rect', 'mixed'], default='mixed',
+                        help='Kind of textline "coords"')
+    parser.add_argument('--region-config', type=str, default='config/vtp.yaml', help='Region configuration')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for region duplication')
+    parser.add_argument('--report', type=str, default=None, help='Write the results as json here')
+    args = parser.parse_args()
+
+    if args.out is not None:
+        out_dir = Path(args.out)
+        if out_dir.exists() and any(out_dir.iterdir()):
+            print(f'{out_dir} is not empty')
+            exit(1)
+    else:
+        out_dir = Path(tempfile.mkdtemp(prefix='checkdata_bench_'))
+    region_config = load_region_config(Path(args.region_config))
+    acc_dir, labelme_dir = out_dir / 'account', out_dir / 'labelme'
+    try:
+        print(f'Generating data in {out_dir}')
+        generate_account(acc_dir, args.files, args.lines, args.page_size, args.coords)
+        ref_json = generate_labelme(labelme_dir, args.files, args.shapes, args.page_size, region_config)
+
+        results = bench_account(acc_dir, args.files, args.lines)
+        results += bench_duplicate_region(labelme_dir, ref_json, region_config, args.files, args.workers)
+        if args.report is not None:
+            json.dump({'args': {k: v for k, v in vars(args).items()}, 'results': results},
+                      open(args.report, 'wt'), indent=4)
+    finally:
+        if not args.keep:
+            # only what was generated, a given --out directory is left in place
+            for generated_dir in [out_dir] if args.out is None else [acc_dir, labelme_dir]:
+                shutil.rmtree(generated_dir, ignore_errors=True)
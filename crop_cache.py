@@ -0,0 +1,169 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+Position = Tuple[int, int]
+
+
+def image_nbytes(image) -> int:
+    """Approximate memory footprint of a PIL image or a NumPy array."""
+    if hasattr(image, 'nbytes'):
+        return int(image.nbytes)
+    width, height = image.size
+    return width * height * len(image.getbands())
+
+
+class CropCache():
+    """LRU cache of display-ready crops, bounded by a memory budget in bytes."""
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: 'OrderedDict[Hashable, Tuple[object, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key, count: bool = True):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            if count:
+                self.hits += 1
+            return item[0]
+
+    def put(self, key, value, nbytes: int):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.
+        return (f'cache {len(self._items)} items, {self.nbytes / 2**20:.1f}MB, '
+                f'hits {self.hits}/{total} ({hit_rate:.0%})')
+
+
+class Prefetcher():
+    """Warms a CropCache with the textlines around the current position of an Account.
+
+    The account must provide `line_count(idx)` so that neighbours can be listed without loading files.
+
+    `loader(acc_file, line_index)` must return a tuple whose first item is the display-ready
+    image; the whole tuple is what gets cached.
+    """
+    def __init__(self, account, loader: Callable, cache: Optional[CropCache] = None,
+                 ahead: int = 8, behind: int = 2, workers: int = 2):
+        self.account = account
+        self.loader = loader
+        self.cache = cache if cache is not None else CropCache()
+        self.ahead = ahead
+        self.behind = behind
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._inflight: Dict[Position, Future] = {}
+        self._wanted = set()
+        self._lock = threading.Lock()
+
+    def neighbours(self, acc_index: int, line_index: int) -> List[Position]:
+        """Positions after and before the given one, nearest first, crossing AccountFile boundaries."""
+        positions = []
+        acc, line = acc_index, line_index
+        for _ in range(self.ahead):
+            line += 1
+            while acc < len(self.account) and line >= self.account.line_count(acc):
+                acc, line = acc + 1, 0
+            if acc >= len(self.account):
+                break
+            positions.append((acc, line))
+
+        acc, line = acc_index, line_index
+        for _ in range(self.behind):
+            line -= 1
+            while acc >= 0 and line < 0:
+                acc -= 1
+                line = self.account.line_count(acc) - 1 if acc >= 0 else -1
+            if acc < 0:
+                break
+            positions.append((acc, line))
+        return positions
+
+    def peek(self, acc_index: int, line_index: int):
+        """Return the cached item for a position, or None without loading it. Only hits are counted."""
+        item = self.cache.get((acc_index, line_index), count=False)
+        if item is not None:
+            self.cache.get((acc_index, line_index))
+        return item
+
+    def get(self, acc_index: int, line_index: int):
+        """Return the cached item for a position, computing it now on a miss."""
+        key = (acc_index, line_index)
+        item = self.cache.get(key)
+        if item is not None:
+            return item
+        with self._lock:
+            future = self._inflight.get(key)
+        if future is not None:
+            try:
+                item = future.result()
+            except Exception:
+                item = None
+            if item is not None:
+                return item
+        return self._load(key)
+
+    def schedule(self, acc_index: int, line_index: int, positions: Optional[List[Position]] = None):
+        """Queue the neighbours of a position, dropping stale requests for older positions.
+
+        `positions` replaces the neighbours in file order, when the positions are walked in another order.
+        """
+        if positions is None:
+            positions = self.neighbours(acc_index, line_index)
+        with self._lock:
+            self._wanted = set(positions)
+            for key in positions:
+                if key in self._inflight or key in self.cache:
+                    continue
+                self._inflight[key] = self._executor.submit(self._prefetch, key)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _prefetch(self, key: Position):
+        try:
+            with self._lock:
+                if key not in self._wanted:
+                    return None
+            return self._load(key)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _load(self, key: Position):
+        acc_index, line_index = key
+        item = self.loader(self.account[acc_index], line_index)
+        self.cache.put(key, item, image_nbytes(item[0]))
+        return item
@@ -0,0 +1,181 @@
+"""Character error rate between the OCR prediction and the label of every textline of an Account.
+
+Lines where both texts agree need no review; `ReviewQueue` orders the others by how much they
+disagree. Scores are cached per sidecar in `CER_CACHE_NAME` and computed again only for the
+sidecars that changed.
+"""
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import jsonio
+from account import Account
+from saver import atomic_write_json
+
+try:
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    Levenshtein = None
+
+CER_CACHE_NAME = '.checkdata_cer.json'
+CER_CACHE_VERSION = 1
+
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance, with the bit-parallel algorithm of Myers (Hyyrö's variant).
+
+    The columns of the DP matrix are encoded as the bits of Python integers, so a text costs
+    a few integer operations per character of the other one, whatever its length.
+    """
+    if Levenshtein is not None:
+        return Levenshtein.distance(a, b)
+    if len(a) < len(b):
+        a, b = b, a
+    m = len(a)
+    if len(b) == 0:
+        return m
+    peq: Dict[str, int] = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    return score
+
+
+def cer_batch(preds: List[str], labels: List[str]) -> np.ndarray:
+    """Character error rate of every (prediction, label) pair, relative to the label length.
+
+    Most pairs are equal, only the others go through `edit_distance`.
+    """
+    scores = np.zeros(len(labels), dtype=np.float32)
+    differ = np.flatnonzero(np.array(preds, dtype=object) != np.array(labels, dtype=object))
+    for i in differ:
+        scores[i] = edit_distance(preds[i], labels[i]) / max(len(labels[i]), 1)
+    return scores
+
+
+def file_scores(json_path: Path) -> np.ndarray:
+    """CER of every textline of a sidecar, texts stripped like `AccountFile.texts`."""
+    textlines = jsonio.load(json_path)
+    return cer_batch([obj['predict_text'].strip() for obj in textlines],
+                     [obj['labling_text'].strip() for obj in textlines])
+
+
+def account_scores(account: Account, workers: int = 1, cache_path: Optional[Path] = None) -> List[np.ndarray]:
+    """CER of every textline of every file of an Account, reusing the cached scores of unchanged sidecars.
+
+    The sidecars to score are spread over `workers` processes.
+    """
+    cache_path = Path(cache_path) if cache_path is not None else account.acc_dir / CER_CACHE_NAME
+    cached: Dict[str, dict] = {}
+    if cache_path.exists():
+        try:
+            cache = jsonio.load(cache_path)
+            if cache.get('version') == CER_CACHE_VERSION:
+                cached = cache['files']
+        except (ValueError, KeyError) as e:
+            print(f'Ignore broken CER cache {cache_path}: {e}')
+
+    rel_paths = [json_path.relative_to(account.acc_dir).as_posix() for json_path in account.acc_jsons]
+    scores: List[Optional[np.ndarray]] = [None] * len(account.acc_jsons)
+    missing = []
+    for idx, (rel_path, entry) in enumerate(zip(rel_paths, account.file_entries)):
+        saved = cached.get(rel_path)
+        if saved is not None and (saved['json_mtime'], saved['json_size']) == (entry['json_mtime'], entry['json_size']):
+            scores[idx] = np.array(saved['cer'], dtype=np.float32)
+        else:
+            missing.append(idx)
+
+    if missing:
+        json_paths = [account.acc_jsons[idx] for idx in missing]
+        if workers > 1 and len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                computed = list(executor.map(file_scores, json_paths, chunksize=max(1, len(missing) // (workers * 4))))
+        else:
+            computed = [file_scores(json_path) for json_path in json_paths]
+        for idx, file_cer in zip(missing, computed):
+            scores[idx] = file_cer
+            entry = account.file_entries[idx]
+            cached[rel_paths[idx]] = {
+                'json_mtime': entry['json_mtime'],
+                'json_size': entry['json_size'],
+                'cer': np.round(file_cer, 4).tolist(),
+            }
+        try:
+            atomic_write_json(cache_path, {'version': CER_CACHE_VERSION, 'files': cached})
+        except OSError as e:
+            print(f'Could not write CER cache {cache_path}: {e}')
+    return scores
+
+
+class ReviewQueue():
+    """Positions (file index, line index) of an Account in descending CER order.
+
+    Lines whose CER is not above `min_cer` are left out when it is given. Ties keep the file order.
+    """
+    def __init__(self, scores: List[np.ndarray], min_cer: Optional[float] = None):
+        acc_indices = np.concatenate([np.full(len(cer), idx) for idx, cer in enumerate(scores)] + [np.zeros(0, int)])
+        line_indices = np.concatenate([np.arange(len(cer)) for cer in scores] + [np.zeros(0, int)])
+        values = np.concatenate(list(scores) + [np.zeros(0, np.float32)])
+        if min_cer is not None:
+            keep = values > min_cer
+            acc_indices, line_indices, values = acc_indices[keep], line_indices[keep], values[keep]
+        order = np.argsort(-values, kind='stable')
+        self.acc_indices = acc_indices[order]
+        self.line_indices = line_indices[order]
+        self.scores = values[order]
+        self._positions: Optional[Dict[Tuple[int, int], int]] = None
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, i) -> Tuple[int, int]:
+        return int(self.acc_indices[i]), int(self.line_indices[i])
+
+    def index_of(self, acc_index: int, line_index: int) -> Optional[int]:
+        if self._positions is None:
+            self._positions = {self[i]: i for i in range(len(self))}
+        return self._positions.get((acc_index, line_index))
+
+    def neighbours(self, i: int, ahead: int, behind: int) -> List[Tuple[int, int]]:
+        """Positions after and before the i-th one in the queue, nearest first."""
+        after = [self[k] for k in range(i + 1, min(i + 1 + ahead, len(self)))]
+        before = [self[k] for k in range(i - 1, max(i - 1 - behind, -1), -1)]
+        return after + before
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('acc_dir', type=str, help='Directory where the images and their json files are located in')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes scoring the json files')
+    parser.add_argument('--min-cer', type=float, default=0., help='Only count the lines with a CER above this')
+    parser.add_argument('--top', type=int, default=20, help='Number of most disagreeing lines to print')
+    args = parser.parse_args()
+
+    account = Account(Path(args.acc_dir))
+    scores = account_scores(account, args.workers)
+    review_queue = ReviewQueue(scores, args.min_cer)
+    total = sum(len(cer) for cer in scores)
+    print(f'{len(review_queue)}/{total} lines with a CER above {args.min_cer}')
+    for i in range(min(args.top, len(review_queue))):
+        acc_index, line_index = review_queue[i]
+        print(f'{review_queue.scores[i]:.3f} {account.acc_jsons[acc_index]} line {line_index}')
@@ -1,10 +1,117 @@
-import copy
-import json
+import os
+import struct
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Tuple
 
 from PIL import Image
 
+import jsonio
+from saver import atomic_write_json
+
+SIZE_CACHE_NAME = '.frame_sizes.json'
+# JPEG start-of-frame markers, the ones carrying the image size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_image_size(image_path: Path) -> Tuple[int, int]:
+    """(width, height) read from the PNG or JPEG header, falling back to PIL for other formats."""
+    with open(image_path, 'rb') as f:
+        head = f.read(26)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:2] == b'\xff\xd8':
+            f.seek(2)
+            while True:
+                byte = f.read(1)
+                while byte and byte != b'\xff':
+                    byte = f.read(1)
+                while byte == b'\xff':
+                    byte = f.read(1)
+                if not byte:
+                    break
+                marker = byte[0]
+                if marker == 0xD9 or marker == 0xDA:
+                    break
+                if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                    continue
+                length = struct.unpack('>H', f.read(2))[0]
+                if marker in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return width, height
+                f.seek(length - 2, os.SEEK_CUR)
+    return Image.open(image_path).size
+
+
+class SizeCache():
+    """Frame sizes persisted next to the frames, reused while a frame's mtime and size do not change."""
+    def __init__(self, path: Path):
+        self.path = path
+        self.sizes: Dict[str, list] = {}
+        self.changed = False
+        if path.exists():
+            try:
+                self.sizes = jsonio.load(path)
+            except ValueError:
+                pass
+
+    def get(self, image_path: Path) -> Tuple[int, int]:
+        stat = image_path.stat()
+        cached = self.sizes.get(image_path.name)
+        if cached is not None and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return cached[2], cached[3]
+        width, height = read_image_size(image_path)
+        self.sizes[image_path.name] = [stat.st_mtime_ns, stat.st_size, width, height]
+        self.changed = True
+        return width, height
+
+    def save(self):
+        if self.changed:
+            atomic_write_json(self.path, self.sizes)
+
+
+class TemplateStamper():
+    """Serializes a labelme template once and only splices in the per-frame fields.
+
+    The template is dumped with a unique placeholder in place of `imagePath`, `imageWidth`
+    and `imageHeight`; stamping a frame joins the pre-encoded pieces with the encoded values,
+    which gives the same bytes as dumping a patched copy of the template.
+    """
+    FIELDS = ('imagePath', 'imageWidth', 'imageHeight')
+
+    def __init__(self, template: dict, compact: bool = False):
+        self.compact = compact
+        template = dict(template)
+        template['imageData'] = None
+        placeholders = {}
+        for field in self.FIELDS:
+            placeholders[field] = f'@@checkdata:{field}:{id(self)}@@'
+            template[field] = placeholders[field]
+        data = jsonio.dumps(template, compact)
+
+        self.parts: List[bytes] = []
+        self.order: List[str] = []
+        while True:
+            found = [(data.find(jsonio.dumps(p, compact)), field) for field, p in placeholders.items()]
+            found = [(pos, field) for pos, field in found if pos >= 0]
+            if not found:
+                break
+            pos, field = min(found)
+            self.parts.append(data[:pos])
+            self.order.append(field)
+            data = data[pos + len(jsonio.dumps(placeholders[field], compact)):]
+            placeholders.pop(field)
+        self.parts.append(data)
+
+    def stamp(self, image_path: str, image_width: int, image_height: int) -> bytes:
+        values = {'imagePath': image_path, 'imageWidth': image_width, 'imageHeight': image_height}
+        chunks = [self.parts[0]]
+        for field, part in zip(self.order, self.parts[1:]):
+            chunks.append(jsonio.dumps(values[field], self.compact))
+            chunks.append(part)
+        return b''.join(chunks)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -12,17 +119,25 @@ if __name__ == "__main__":
     parser.add_argument('frame_dir', type=str, help='Directory where the frames are located in')
     parser.add_argument('--ext', default='jpg', help='Image extension')
     parser.add_argument('--ignore', '-i', nargs='*', default=[], help='Labels to be ignored')
+    parser.add_argument('--compact', action='store_true', help='Write json on a single line instead of indented')
+    parser.add_argument('--workers', type=int, default=8, help='Number of threads writing json files')
     args = parser.parse_args()
 
-    json_dict_template = json.load(open(args.ref_json, 'rt'))
+    json_dict_template = jsonio.load(args.ref_json)
     json_dict_template['shapes'] = [shape for shape in json_dict_template['shapes'] if shape['label'] not in args.ignore]
+    stamper = TemplateStamper(json_dict_template, args.compact)
 
-    frames = Path(args.frame_dir).glob(f'*.{args.ext}')
-    for frame_path in frames:
-        print('-' * 30)
+    frame_dir = Path(args.frame_dir)
+    size_cache = SizeCache(frame_dir / SIZE_CACHE_NAME)
+    frames = sorted(frame_dir.glob(f'*.{args.ext}'))
+
+    def process_frame(frame_path: Path):
         print(f'Processing frame {frame_path}')
-        json_dict = copy.deepcopy(json_dict_template)
-        json_dict['imagePath'] = frame_path.name
-        json_dict['imageWidth'], json_dict['imageHeight'] = Image.open(frame_path).size
-        json_dict['imageData'] = None
-        json.dump(json_dict, open(frame_path.with_suffix('.json'), 'wt', encoding='utf8'), ensure_ascii=False, indent=4)
+        image_width, image_height = size_cache.get(frame_path)
+        frame_path.with_suffix('.json').write_bytes(stamper.stamp(frame_path.name, image_width, image_height))
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        for _ in executor.map(process_frame, frames):
+            pass
+    size_cache.save()
+    print(f'Stamped {len(frames)} frames')
@@ -1,14 +1,28 @@
-import copy
+import hashlib
 import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
 from argparse import ArgumentParser
+from collections import deque
 from json.decoder import JSONDecoder
 from pathlib import Path
-from typing import List, Optional, Tuple, Dict, Union
+from typing import Deque, List, Optional, Tuple, Dict, Union
 import cv2
 from shapely import geometry
 import numpy as np
 from PIL import Image
 
+import jsonio
+from homography import QUAD_DEGENERACY_NAMES, order_quads, perspective_transforms, quad_degeneracy
+from saver import atomic_write_json
+
+MANIFEST_NAME = '.duplicate_region_manifest.json'
+MANIFEST_VERSION = 2
+
 
 def order_points(points):
     if len(points) == 4:
@@ -32,23 +46,72 @@ class Shape():
         self.group_id = shape['group_id']
         self.flags = shape['flags']
 
+    @property
+    def points(self):
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._points = points
+        # geometries below are derived from the points and built on first use
+        self._polygon = None
+        self._line = None
+        self._bounds = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_polygon=None, _line=None)
+        return state
+
+    @property
+    def polygon(self) -> geometry.Polygon:
+        if self._polygon is None:
+            self._polygon = geometry.Polygon(self.points)
+        return self._polygon
+
+    @property
+    def line(self) -> geometry.LineString:
+        if self._line is None:
+            self._line = geometry.LineString(self.points)
+        return self._line
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """Bounding box (min_x, min_y, max_x, max_y) of the points."""
+        if self._bounds is None:
+            if len(self.points) == 0:
+                self._bounds = (np.inf, np.inf, -np.inf, -np.inf)
+            else:
+                points = np.array(self.points, dtype=np.float64).reshape(-1, 2)
+                self._bounds = (*points.min(axis=0).tolist(), *points.max(axis=0).tolist())
+        return self._bounds
+
     def __repr__(self) -> str:
         return f'Shape({self.label}, {self.points})'
 
     def is_child(self, parent: 'Shape'):
         ratio = 0.
-        polyA = geometry.Polygon(parent.points)
+        polyA = parent.polygon
         if len(self.points) == 4:
-            polyB = geometry.Polygon(self.points)
+            polyB = self.polygon
             if polyA.intersects(polyB):
                 ratio = polyA.intersection(polyB).area / polyB.area
         elif len(self.points) == 2:
-            line = geometry.LineString(self.points)
+            line = self.line
             if line.intersection(polyA).within(polyA):
                 ratio = 1.0
         return ratio >= 0.6
 
 
+    def to_dict(self) -> dict:
+        return {
+            'label': self.label,
+            'points': self.points,
+            "group_id": self.group_id,
+            "shape_type": self.type,
+            "flags": self.flags,
+        }
+
     def astype(self, othertype):
         assert othertype in ['line', 'polygon', 'rectangle']
         if len(self.points) == 2 and self.type == 'rectangle' and othertype == 'polygon':
@@ -94,6 +157,21 @@ class Annotation():
         self.image_height = image_height
         self.shapes = list(map(Shape, shapes))
 
+    @property
+    def shapes(self) -> List[Shape]:
+        return self._shapes
+
+    @shapes.setter
+    def shapes(self, shapes: List[Shape]):
+        self._shapes = shapes
+        self._bounds = None
+
+    def bounds(self) -> np.ndarray:
+        """(N, 4) bounding boxes of the shapes, used to pick candidates before exact geometry tests."""
+        if self._bounds is None:
+            self._bounds = np.array([shape.bounds for shape in self.shapes], dtype=np.float64).reshape(-1, 4)
+        return self._bounds
+
     def __iter__(self):
         for shape in self.shapes:
             yield shape
@@ -109,7 +187,7 @@ class Annotation():
 
     @classmethod
     def parse_from_labelme(cls, json_path):
-        json_dict = json.load(open(json_path, 'rt'))
+        json_dict = jsonio.load(json_path)
         return cls(json_dict['imagePath'],
                    json_dict['imageHeight'],
                    json_dict['imageWidth'],
@@ -139,48 +217,577 @@ class Annotation():
             return results
 
     def find_childs(self, ref_shape):
-        childs: List[Shape] = [shape for shape in self.shapes if shape.is_child(ref_shape) and shape != ref_shape]
+        # only shapes whose bounding box touches the parent's can overlap it
+        min_x, min_y, max_x, max_y = ref_shape.bounds
+        bounds = self.bounds()
+        candidates = np.flatnonzero((bounds[:, 0] <= max_x) & (bounds[:, 2] >= min_x)
+                                    & (bounds[:, 1] <= max_y) & (bounds[:, 3] >= min_y))
+        childs: List[Shape] = [self.shapes[i] for i in candidates
+                               if self.shapes[i] != ref_shape and self.shapes[i].is_child(ref_shape)]
         return childs
 
     def add_shapes(self, shapes: List[Shape]):
-        self.shapes.extend(shapes)
+        self.shapes = self.shapes + list(shapes)
 
     def remove_shapes(self, shapes: List[Shape]):
         self.shapes = [shape for shape in self.shapes if shape not in shapes]
 
-    def to_json(self, path: Path):
-        # print(json.dumps(anno_new.__dict__, default=serializer))
-        json.dump(self, open(path, 'wt', encoding='utf8'), ensure_ascii=False, indent=4, default=labelme_serializer)
+    def to_dict(self) -> dict:
+        return {
+            'version': '4.5.6',
+            'flags': {},
+            'shapes': [shape.to_dict() for shape in self.shapes],
+            'imageData': None,
+            'imagePath': self.image_path,
+            'imageHeight': self.image_height,
+            'imageWidth': self.image_width,
+        }
+
+    def to_json(self, path: Path, compact: bool = False):
+        jsonio.dump(self.to_dict(), path, compact)
 
 
 def labelme_serializer(obj):
     """JSON serializer for objects not serializable by default json code"""
 
-    if isinstance(obj, Annotation):
-        d = {
-            'version': '4.5.6',
-            'flags': {},
-            'shapes': obj.shapes,
-            'imageData': None,
-            'imagePath': obj.image_path,
-            'imageHeight': obj.image_height,
-            'imageWidth': obj.image_width,
-        }
-        return d
-
-    if isinstance(obj, Shape):
-        d = {
-            'label': obj.label,
-            'points': obj.points,
-            "group_id": obj.group_id,
-            "shape_type": obj.type,
-            "flags": obj.flags,
-        }
-        return d
+    if isinstance(obj, (Annotation, Shape)):
+        return obj.to_dict()
 
     return obj.__dict__
 
 
+def load_region_config(region_path: Path) -> dict:
+    region_path = Path(region_path)
+    if region_path.suffix == '.yaml':
+        import yaml
+        region_config = yaml.safe_load(open(region_path, 'rt'))
+    elif region_path.suffix == '.json':
+        region_config = jsonio.load(region_path)
+    else:
+        raise ValueError('Unsupport file type. Should be .yaml or .json')
+
+    assert 'names' in region_config.keys()
+    return region_config
+
+
+class MappingPlan():
+    """What every target file needs from the reference annotation, compiled once.
+
+    Replaying `find`/`find_childs`/`remove_shapes` on a deep copy of the reference for each
+    file is replaced by index bookkeeping: the children of every reference region and the
+    shapes of every `depend` entry are found once, and the points of all reference shapes
+    (ordered like `Shape.map` does) live in a single buffer, so a region costs one
+    `cv2.perspectiveTransform` over all of its children's points. The homographies of all the
+    regions of a batch of files are solved together by `apply_batch`.
+    """
+    def __init__(self, anno_ref: Annotation, region_config: dict):
+        self.names = region_config['names']
+        self.depend = region_config.get('depend') or {}
+        self.shapes: List[Shape] = list(anno_ref.shapes)
+        # changes whenever the reference or the region config does, see `process_file`
+        self.digest = digest([anno_ref.to_dict(), region_config])
+
+        arrays = [np.array(order_points(shape.points), dtype=np.float32).reshape(-1, 2) for shape in self.shapes]
+        self.points = np.concatenate(arrays) if arrays else np.zeros((0, 2), dtype=np.float32)
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+
+        self.regions: Dict[str, List[int]] = {}
+        for i, shape in enumerate(self.shapes):
+            if shape.label in self.names:
+                self.regions.setdefault(shape.label, []).append(i)
+        positions = {id(shape): i for i, shape in enumerate(self.shapes)}
+        self.childs: Dict[int, List[int]] = {}
+        for indices in self.regions.values():
+            for i in indices:
+                self.childs[i] = [positions[id(child)] for child in anno_ref.find_childs(self.shapes[i])]
+
+        # `Annotation.find` semantics: a label matches when it is `in` the depend name / label list
+        self.depend_regions = {name: [i for i, shape in enumerate(self.shapes) if shape.label in name]
+                               for name in self.depend}
+        self.depend_shapes = {name: [i for i, shape in enumerate(self.shapes) if shape.label in labels]
+                              for name, labels in self.depend.items()}
+
+    @staticmethod
+    def first_left(indices: List[int], removed: np.ndarray) -> Optional[int]:
+        for i in indices:
+            if not removed[i]:
+                return i
+        return None
+
+    def map_shapes(self, indices: List[int], transform: np.ndarray) -> List[Shape]:
+        """Map several reference shapes with a single perspective transform call."""
+        if len(indices) == 0:
+            return []
+        point_indices = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in indices])
+        if len(point_indices) == 0:
+            dst_array = np.zeros((0, 2), dtype=np.float32)
+        else:
+            dst_array = cv2.perspectiveTransform(self.points[point_indices][None], transform)[0]
+
+        mapped = []
+        start = 0
+        for i in indices:
+            ref = self.shapes[i]
+            end = start + self.offsets[i + 1] - self.offsets[i]
+            mapped.append(Shape({
+                'label': ref.label,
+                'points': dst_array[start:end].tolist(),
+                'shape_type': ref.type,
+                'flags': ref.flags,
+                'group_id': ref.group_id
+            }))
+            start = end
+        return mapped
+
+    def match(self, anno_new: Annotation) -> Optional[List[Tuple[int, Shape, List[int]]]]:
+        """Region pairs of a file: (reference region, new region, reference shapes it maps), when it maps any.
+
+        Drops the shapes of `anno_new` that are not regions. None when it has no region.
+        """
+        region_news = anno_new.find(self.names)
+        if len(region_news) == 0:
+            print('Empty region annotations!')
+            return None
+
+        anno_new.keep_labels(self.names)
+        pairs = []
+        # reference shapes already mapped, to avoid duplication
+        removed = np.zeros(len(self.shapes), dtype=bool)
+
+        for region_new in region_news:
+            ref_index = self.first_left(self.regions.get(region_new.label, []), removed)
+            if ref_index is None:
+                print(f'Not found corresponding region name = {region_new.label} annotation in reference. Skip')
+                continue
+            childs = [i for i in self.childs[ref_index] if not removed[i]]
+            if childs:
+                pairs.append((ref_index, region_new, childs))
+            removed[childs] = True
+
+        for depend_region_name in self.depend:
+            ref_index = self.first_left(self.depend_regions[depend_region_name], removed)
+            if ref_index is None:
+                print(f'Unknow depend region name in reference, name = {depend_region_name}. Skip!')
+                continue
+            region_new = anno_new.find(depend_region_name, first=True)
+            if region_new is None:
+                print(f'Unknow depend region name in new, name = {depend_region_name}. Skip!')
+                continue
+            shapes = [i for i in self.depend_shapes[depend_region_name] if not removed[i]]
+            if shapes:
+                pairs.append((ref_index, region_new, shapes))
+            removed[shapes] = True
+        return pairs
+
+    def apply_batch(self, annos: List[Annotation]) -> List[Optional[List[str]]]:
+        """Add the mapped reference shapes to many annotations, solving all of their homographies at once.
+
+        Returns, per annotation, None when it has no region, otherwise the problems of the region
+        pairs skipped because one of the regions has no homography: not 4 points, duplicate or
+        collinear corners.
+        """
+        matches = [self.match(anno) for anno in annos]
+        problems = [None if match is None else [] for match in matches]
+        pairs = [(k, *pair) for k, match in enumerate(matches) if match is not None for pair in match]
+
+        quad = np.array([self.offsets[ref_index + 1] - self.offsets[ref_index] == 4 and len(region_new.points) == 4
+                         for _, ref_index, region_new, _ in pairs], dtype=bool)
+        src = np.zeros((len(pairs), 4, 2), dtype=np.float32)
+        dst = np.zeros((len(pairs), 4, 2), dtype=np.float32)
+        for j in np.flatnonzero(quad):
+            _, ref_index, region_new, _ = pairs[j]
+            src[j] = self.points[self.offsets[ref_index]:self.offsets[ref_index + 1]]
+            dst[j] = region_new.points
+        dst[quad] = order_quads(dst[quad])
+        src_codes, dst_codes = quad_degeneracy(src), quad_degeneracy(dst)
+
+        solvable = quad & (src_codes == 0) & (dst_codes == 0)
+        transforms = np.full((len(pairs), 3, 3), np.nan)
+        ok = np.zeros(len(pairs), dtype=bool)
+        transforms[solvable], ok[solvable] = perspective_transforms(src[solvable], dst[solvable])
+
+        mapped: List[List[Shape]] = [[] for _ in annos]
+        for j, (k, ref_index, region_new, indices) in enumerate(pairs):
+            if not quad[j]:
+                problem = 'not 4 points'
+            elif src_codes[j]:
+                problem = f'{QUAD_DEGENERACY_NAMES[src_codes[j]]} in reference'
+            elif dst_codes[j]:
+                problem = QUAD_DEGENERACY_NAMES[dst_codes[j]]
+            elif not ok[j]:
+                problem = 'singular homography'
+            else:
+                mapped[k].extend(self.map_shapes(indices, transforms[j]))
+                continue
+            print(f'Degenerate region {region_new.label}: {problem}. Skip')
+            problems[k].append(f'{region_new.label}: {problem}')
+        for anno_new, shapes in zip(annos, mapped):
+            if shapes:
+                anno_new.add_shapes(shapes)
+        return problems
+
+    def apply(self, anno_new: Annotation) -> bool:
+        """Add the mapped reference shapes to `anno_new`, return False when it has no region."""
+        return self.apply_batch([anno_new])[0] is not None
+
+
+def digest(obj) -> str:
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode('utf8')).hexdigest()
+
+
+def is_unchanged(entry: Optional[dict], inputs: str, output: Optional[str] = None,
+                 stat: Optional[os.stat_result] = None) -> bool:
+    """Whether a manifest entry says a file is up to date, from its stat or from the digest of its annotation.
+
+    Only the annotation we wrote is up to date, a file restored to its original content is processed again.
+    """
+    if entry is None or entry['inputs'] != inputs:
+        return False
+    if stat is not None:
+        return entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+    return output == entry['output']
+
+
+def process_files(jobs: List[Tuple[Path, Optional[dict]]], plan: MappingPlan, compact: bool = False) -> List[dict]:
+    """Map the reference shapes onto the regions of labelme files and save them in place.
+
+    A job is a file and what the manifest recorded for it on a previous run; the file is skipped
+    when neither the reference nor the region config changed since and it still holds what was written.
+    The homographies of all the files are solved together. Failures are reported in the
+    results instead of raised, with the status, the time spent and the new manifest entry.
+    """
+    inputs = digest([MANIFEST_VERSION, plan.digest, compact])
+    results = []
+    pending: List[Tuple[dict, Annotation]] = []
+    for json_path, entry in jobs:
+        start = time.perf_counter()
+        result = {'path': str(json_path), 'status': 'skipped', 'seconds': 0., 'error': None, 'manifest': entry,
+                  'degenerate': []}
+        results.append(result)
+        try:
+            if is_unchanged(entry, inputs, stat=json_path.stat()):
+                print(f'Skip unchanged {json_path}')
+            else:
+                print(f'Processing {json_path}')
+                anno_new: Annotation = Annotation.parse_from_labelme(json_path)
+                if is_unchanged(entry, inputs, digest(anno_new.to_dict())):
+                    print(f'Skip unchanged {json_path}')
+                    stat = json_path.stat()
+                    result['manifest'] = dict(entry, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                else:
+                    pending.append((result, anno_new))
+        except Exception as e:
+            fail(result, e)
+        result['seconds'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        problems = plan.apply_batch([anno_new for _, anno_new in pending])
+    except Exception:
+        # find out which file breaks the batch
+        problems = []
+        for result, anno_new in pending:
+            try:
+                problems.append(plan.apply_batch([anno_new])[0])
+            except Exception as e:
+                fail(result, e)
+                problems.append(None)
+    for result, _ in pending:
+        result['seconds'] += (time.perf_counter() - start) / len(pending)
+
+    for (result, anno_new), file_problems in zip(pending, problems):
+        if result['status'] == 'failed':
+            continue
+        start = time.perf_counter()
+        json_path = Path(result['path'])
+        try:
+            result['status'] = 'empty'
+            if file_problems is not None:
+                anno_new.to_json(json_path, compact)
+                result['status'] = 'done'
+                result['degenerate'] = file_problems
+            stat = json_path.stat()
+            result['manifest'] = {
+                'inputs': inputs,
+                'output': digest(anno_new.to_dict()),
+                'mtime_ns': stat.st_mtime_ns,
+                'size': stat.st_size,
+            }
+        except Exception as e:
+            fail(result, e)
+        result['seconds'] += time.perf_counter() - start
+    return results
+
+
+def fail(result: dict, error: Exception):
+    result['status'] = 'failed'
+    result['error'] = f'{type(error).__name__}: {error}'
+    result['manifest'] = None
+    print(f'Failed to process {result["path"]}: {result["error"]}')
+
+
+# Shipped once to every worker process by `_init_worker` instead of being pickled with each task
+_worker_plan: Optional[MappingPlan] = None
+_worker_compact = False
+
+
+def _init_worker(plan: MappingPlan, compact: bool):
+    global _worker_plan, _worker_compact
+    _worker_plan = plan
+    _worker_compact = compact
+
+
+def _process_in_worker(jobs: List[Tuple[Path, Optional[dict]]]) -> List[dict]:
+    return process_files(jobs, _worker_plan, _worker_compact)
+
+
+def run(json_paths: List[Path], plan: MappingPlan, workers: int = 1, chunksize: Optional[int] = None,
+        compact: bool = False, manifest: Optional[Dict[str, dict]] = None) -> List[dict]:
+    """Process every file, in a pool of `workers` processes when more than one, and collect their results.
+
+    Files are processed by chunks of `chunksize`, whose homographies are solved together.
+    `manifest` maps file names to the entries of a previous run, see `process_files`.
+    """
+    manifest = manifest or {}
+    jobs = [(json_path, manifest.get(json_path.name)) for json_path in json_paths]
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * 4)) if workers > 1 else 64
+    chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+    if workers <= 1:
+        return [result for chunk in chunks for result in process_files(chunk, plan, compact)]
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(plan, compact)) as pool:
+        return [result for results in pool.imap_unordered(_process_in_worker, chunks) for result in results]
+
+
+def load_manifest(path: Path) -> Dict[str, dict]:
+    try:
+        manifest = jsonio.load(path)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['files']
+
+
+def update_manifest(manifest: Dict[str, dict], results: List[dict]):
+    for result in results:
+        name = Path(result['path']).name
+        if result['manifest'] is None:
+            manifest.pop(name, None)
+        else:
+            manifest[name] = result['manifest']
+
+
+def save_manifest(path: Path, manifest: Dict[str, dict], results: List[dict]):
+    manifest = dict(manifest)
+    update_manifest(manifest, results)
+    atomic_write_json(path, {'version': MANIFEST_VERSION, 'files': manifest})
+
+
+def summarize(results: List[dict]) -> dict:
+    counts: Dict[str, int] = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    seconds = [result['seconds'] for result in results]
+    return {
+        'files': len(results),
+        'counts': counts,
+        'total_seconds': sum(seconds),
+        'max_seconds': max(seconds, default=0.),
+        'failures': [{k: v for k, v in result.items() if k != 'manifest'}
+                     for result in results if result['status'] == 'failed'],
+        'degenerate': [{'path': result['path'], 'regions': result['degenerate']}
+                       for result in results if result['degenerate']],
+    }
+
+
+class StreamProcessor():
+    """Processes labelme files as their paths arrive, keeping the plan loaded.
+
+    Paths are `submit`ted by producer threads into a bounded queue, so that producers block when
+    processing falls behind; `run` takes whatever is queued, up to `chunksize` files at a time,
+    until `close` is called and the queue is drained. The manifest is updated after every chunk,
+    so a file whose mtime and size are the ones recorded, our own writes included, is current
+    and does not need to be submitted again.
+    """
+    def __init__(self, plan: MappingPlan, manifest: Dict[str, dict], manifest_path: Path, compact: bool = False,
+                 workers: int = 1, chunksize: int = 16, max_queue: int = 256, stats_interval: float = 10.,
+                 save_interval: float = 5.):
+        self.plan = plan
+        self.manifest = manifest
+        self.manifest_path = manifest_path
+        self.compact = compact
+        self.workers = workers
+        self.chunksize = max(1, chunksize)
+        self.stats_interval = stats_interval
+        self.save_interval = save_interval
+        self.queue: 'queue.Queue[Optional[Path]]' = queue.Queue(maxsize=max(1, max_queue))
+        # queued or being processed
+        self._queued = set()
+        # stat of the files that failed, they are only retried once they change
+        self._failed: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.start = time.perf_counter()
+        self.files = 0
+        self.counts: Dict[str, int] = {}
+        self.total_seconds = 0.
+        self.max_seconds = 0.
+        self.failures: List[dict] = []
+        self.degenerate: List[dict] = []
+        self._last_stats = (self.start, 0)
+        self._last_save = self.start
+        self._manifest_changed = False
+
+    def is_current(self, json_path: Path, stat: os.stat_result) -> bool:
+        """Whether a file is up to date (or failed) as it is now, according to the manifest."""
+        with self._lock:
+            entry = self.manifest.get(json_path.name)
+            failed = self._failed.get(json_path.name)
+        if entry is not None and (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+            return True
+        return failed == (stat.st_mtime_ns, stat.st_size)
+
+    def submit(self, json_path: Path):
+        """Queue a file, blocking while the queue is full. A file already queued is not queued twice."""
+        with self._lock:
+            if json_path in self._queued:
+                return
+            self._queued.add(json_path)
+        self.queue.put(json_path)
+
+    def close(self):
+        """No more files will be submitted, `run` returns once the queued ones are processed."""
+        self.queue.put(None)
+
+    def next_chunk(self) -> List[Path]:
+        try:
+            json_path = self.queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        chunk = []
+        while json_path is not None:
+            chunk.append(json_path)
+            if len(chunk) == self.chunksize:
+                return chunk
+            try:
+                json_path = self.queue.get_nowait()
+            except queue.Empty:
+                return chunk
+        self._closed = True
+        return chunk
+
+    def run(self):
+        pool = None
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self.plan, self.compact))
+        inflight: Deque = deque()
+        try:
+            while True:
+                chunk = [] if self._closed else self.next_chunk()
+                if chunk:
+                    with self._lock:
+                        jobs = [(json_path, self.manifest.get(json_path.name)) for json_path in chunk]
+                    if pool is None:
+                        self.collect(process_files(jobs, self.plan, self.compact))
+                    else:
+                        inflight.append(pool.apply_async(_process_in_worker, (jobs,)))
+                # at most two chunks per worker are in flight, the rest waits in the bounded queue
+                while inflight and (inflight[0].ready() or len(inflight) >= 2 * self.workers or self._closed):
+                    self.collect(inflight.popleft().get())
+                self.report()
+                if self._closed and not inflight:
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self.save_manifest()
+
+    def collect(self, results: List[dict]):
+        with self._lock:
+            update_manifest(self.manifest, results)
+            for result in results:
+                json_path = Path(result['path'])
+                self._queued.discard(json_path)
+                if result['status'] == 'failed':
+                    try:
+                        stat = json_path.stat()
+                        self._failed[json_path.name] = (stat.st_mtime_ns, stat.st_size)
+                    except OSError:
+                        pass
+                else:
+                    self._failed.pop(json_path.name, None)
+        self._manifest_changed = True
+        for result in results:
+            self.files += 1
+            self.counts[result['status']] = self.counts.get(result['status'], 0) + 1
+            self.total_seconds += result['seconds']
+            self.max_seconds = max(self.max_seconds, result['seconds'])
+            if result['status'] == 'failed':
+                self.failures.append({k: v for k, v in result.items() if k != 'manifest'})
+            if result['degenerate']:
+                self.degenerate.append({'path': result['path'], 'regions': result['degenerate']})
+
+    def report(self):
+        now = time.perf_counter()
+        if now - self._last_save >= self.save_interval:
+            self.save_manifest()
+        last_time, last_files = self._last_stats
+        if now - last_time < self.stats_interval:
+            return
+        rate = (self.files - last_files) / (now - last_time)
+        print(f'[stream] {self.files} files, {rate:.1f} files/s, queue {self.queue.qsize()}/{self.queue.maxsize}, '
+              f'{self.counts}')
+        self._last_stats = (now, self.files)
+
+    def save_manifest(self):
+        self._last_save = time.perf_counter()
+        if not self._manifest_changed:
+            return
+        with self._lock:
+            manifest = dict(self.manifest)
+        atomic_write_json(self.manifest_path, {'version': MANIFEST_VERSION, 'files': manifest})
+        self._manifest_changed = False
+
+    def summary(self) -> dict:
+        """Same as `summarize` over everything processed so far."""
+        return {
+            'files': self.files,
+            'counts': self.counts,
+            'total_seconds': self.total_seconds,
+            'max_seconds': self.max_seconds,
+            'failures': self.failures,
+            'degenerate': self.degenerate,
+        }
+
+
+def read_paths(stream, processor: StreamProcessor):
+    """Submit the paths read from a text stream, one per line, then close the processor."""
+    try:
+        for line in stream:
+            if line.strip():
+                processor.submit(Path(line.strip()))
+    finally:
+        processor.close()
+
+
+def watch_dir(json_dir: Path, processor: StreamProcessor, interval: float, stop: threading.Event):
+    """Submit the new and changed json files of a directory every `interval` seconds until `stop` is set."""
+    while not stop.is_set():
+        for json_path in sorted(json_dir.glob('*.json')):
+            if json_path.name.startswith('.') or stop.is_set():
+                continue
+            try:
+                stat = json_path.stat()
+            except FileNotFoundError:
+                continue
+            if not processor.is_current(json_path, stat):
+                processor.submit(json_path)
+        stop.wait(interval)
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument('ref_json', type=str, help='Reference json file which will be duplicated for each image')
@@ -188,66 +795,64 @@ if __name__ == "__main__":
     parser.add_argument('json_dir', type=str,
                         help='Directory where the frames are located in')
     parser.add_argument('--ext', default='jpg', help='Image extension')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Files sent to a worker at once, their homographies are solved together')
+    parser.add_argument('--report', type=str, default=None, help='Where to write the json summary of the run')
+    parser.add_argument('--compact', action='store_true', help='Write json on a single line instead of indented')
+    parser.add_argument('--force', action='store_true', help='Process every file, even the unchanged ones')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--stdin', action='store_true', help='Process the json paths read from stdin, one per line')
+    source.add_argument('--watch', type=float, default=None, metavar='SECONDS',
+                        help='Keep running, polling json_dir for new and changed files every SECONDS')
+    parser.add_argument('--queue-size', type=int, default=256, help='Files waiting to be processed in stream mode')
+    parser.add_argument('--stats-interval', type=float, default=10., help='Seconds between stream mode stats')
     args = parser.parse_args()
 
-    region_path = Path(args.region_path)
-    if region_path.suffix == '.yaml':
-        import yaml
-        region_config = yaml.safe_load(open(region_path, 'rt'))
-    elif region_path.suffix == '.json':
-        import json
-        region_config = json.load(open(region_path, 'rt'))
-    else:
-        print('Unsupport file type. Should be .yaml or .json')
+    try:
+        region_config = load_region_config(Path(args.region_path))
+    except ValueError as e:
+        print(e)
         exit(-1)
 
-    assert 'names' in region_config.keys()
-
     back_anno_ref: Annotation = Annotation.parse_from_labelme(args.ref_json)
     if region_config.get('ignore', None) is not None:
         back_anno_ref.remove_labels(region_config['ignore'])
 
+    plan = MappingPlan(back_anno_ref, region_config)
     json_dir = Path(args.json_dir)
-    for json_path in json_dir.glob(f'*.json'):
-        print(f'Processing {json_path}')
-        anno_ref: Annotation = copy.deepcopy(back_anno_ref)
-        anno_new: Annotation = Annotation.parse_from_labelme(json_path)
-
-        region_news = anno_new.find(region_config['names'])
-        if len(region_news) == 0:
-            print('Empty region annotations!')
-            continue
-
-        anno_new.keep_labels(region_config['names'])
-
-        for region_new in region_news:
-            region_ref: Shape = anno_ref.find([region_new.label], first=True)
-            if region_ref is None:
-                print(f'Not found corresponding region name = {region_new.label} annotation in reference. Skip')
-                continue
-
-            transform = region_ref.find_transform(region_new)
-            region_ref_childs = anno_ref.find_childs(region_ref)
-            region_new_childs = [child.map(transform) for child in region_ref_childs]
-            anno_new.add_shapes(region_new_childs)
-            # remove to avoid duplication
-            anno_ref.remove_shapes(region_ref_childs)
-
-        if 'depend' in region_config.keys():
-            dependence = region_config['depend']
-            for depend_region_name, depend_labels in dependence.items():
-                region_ref = anno_ref.find(depend_region_name, first=True)
-                if region_ref is None:
-                    print(f'Unknow depend region name in reference, name = {depend_region_name}. Skip!')
-                    continue
-                region_new = anno_new.find(depend_region_name, first=True)
-                if region_new is None:
-                    print(f'Unknow depend region name in new, name = {depend_region_name}. Skip!')
-                    continue
-                transform = region_ref.find_transform(region_new)
-                shapes = anno_ref.find(depend_labels)
-                mapped_shapes = [shape.map(transform) for shape in shapes]
-                anno_new.add_shapes(mapped_shapes)
-                anno_ref.remove_shapes(shapes)
-
-        anno_new.to_json(json_path)
+    # hidden json files are bookkeeping, like the manifest itself
+    json_paths = sorted(path for path in json_dir.glob('*.json') if not path.name.startswith('.'))
+    manifest_path = json_dir / MANIFEST_NAME
+    manifest = {} if args.force else load_manifest(manifest_path)
+    start = time.perf_counter()
+    if args.stdin or args.watch is not None:
+        processor = StreamProcessor(plan, manifest, manifest_path, args.compact, args.workers, args.chunksize or 16,
+                                    args.queue_size, args.stats_interval)
+        stop = threading.Event()
+        if args.stdin:
+            producer = threading.Thread(target=read_paths, args=(sys.stdin, processor), daemon=True)
+        else:
+            producer = threading.Thread(target=watch_dir, args=(json_dir, processor, args.watch, stop), daemon=True)
+        producer.start()
+        try:
+            processor.run()
+        except KeyboardInterrupt:
+            stop.set()
+        summary = processor.summary()
+    else:
+        results = run(json_paths, plan, args.workers, args.chunksize, args.compact, manifest)
+        save_manifest(manifest_path, manifest, results)
+        summary = summarize(results)
+    summary['wall_seconds'] = time.perf_counter() - start
+
+    print('-' * 30)
+    print(f'Processed {summary["files"]} files in {summary["wall_seconds"]:.2f}s: {summary["counts"]}')
+    for failure in summary['failures']:
+        print(f'FAILED {failure["path"]}: {failure["error"]}')
+    for degenerate in summary['degenerate']:
+        print(f'DEGENERATE {degenerate["path"]}: {", ".join(degenerate["regions"])}')
+    if args.report is not None:
+        json.dump(summary, open(args.report, 'wt', encoding='utf8'), ensure_ascii=False, indent=4)
+    if summary['failures']:
+        exit(1)
@@ -0,0 +1,131 @@
+import io
+import json
+import tarfile
+import time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Deque, List, Optional, Tuple
+
+from account import Account, AccountFile
+from image_pool import ImagePool
+
+Sample = Tuple[int, bytes, str, str]
+
+
+def extract_file(image_path: Path, json_path: Path, image_format: str = 'png') -> List[Sample]:
+    """Every non-empty textline crop of a page, encoded, with (line index, bytes, labling_text, predict_text)."""
+    # a pool of its own, dropped with the page once it is extracted
+    acc_file = AccountFile(image_path, json_path, image_pool=ImagePool(max_open=1))
+    samples = []
+    for idx, crop in acc_file.crops():
+        buffer = io.BytesIO()
+        if image_format == 'jpg' and crop.mode not in ('RGB', 'L'):
+            crop = crop.convert('RGB')
+        crop.save(buffer, format='JPEG' if image_format == 'jpg' else image_format.upper())
+        predict_text, labling_text = acc_file.texts(idx)
+        samples.append((idx, buffer.getvalue(), labling_text, predict_text))
+    return samples
+
+
+class ShardWriter():
+    """Writes samples into numbered tar shards of at most `shard_size` samples, plus a jsonl index.
+
+    Each sample is stored as `<key>.<ext>` (the crop) and `<key>.txt` (its label).
+    """
+    def __init__(self, out_dir: Path, shard_size: int = 10000, image_format: str = 'png'):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.image_format = image_format
+        self.index = open(self.out_dir / 'index.jsonl', 'wt', encoding='utf8')
+        self.shard_id = -1
+        self.shard: Optional[tarfile.TarFile] = None
+        self.shard_count = 0
+        self.samples = 0
+
+    def _add(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.shard.addfile(info, io.BytesIO(data))
+
+    def write(self, source: str, line: int, image: bytes, text: str, predict_text: str):
+        if self.shard is None or self.shard_count >= self.shard_size:
+            self.next_shard()
+        key = f'{self.samples:09d}'
+        self._add(f'{key}.{self.image_format}', image)
+        self._add(f'{key}.txt', text.encode('utf8'))
+        self.index.write(json.dumps({
+            'shard': self.shard_name, 'key': key, 'image': source, 'line': line,
+            'text': text, 'predict_text': predict_text,
+        }, ensure_ascii=False) + '\n')
+        self.shard_count += 1
+        self.samples += 1
+
+    @property
+    def shard_name(self) -> str:
+        return f'shard-{self.shard_id:05d}.tar'
+
+    def next_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+        self.shard_id += 1
+        self.shard_count = 0
+        self.shard = tarfile.open(self.out_dir / self.shard_name, 'w')
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+        self.index.close()
+
+
+def export(account: Account, writer: ShardWriter, workers: int = 1, image_format: str = 'png'):
+    """Stream every page of `account` through a process pool into `writer`, keeping page order.
+
+    At most `2 * workers` pages are in flight, so memory does not grow with the dataset.
+    """
+    jobs = zip(account.acc_images, account.acc_jsons)
+    pending: Deque[Tuple[Path, Future]] = deque()
+    start = time.perf_counter()
+
+    def drain_one():
+        image_path, future = pending.popleft()
+        source = image_path.relative_to(account.acc_dir).as_posix()
+        try:
+            samples = future.result()
+        except Exception as e:
+            print(f'Failed to export {image_path}: {type(e).__name__}: {e}')
+            return
+        for line, image, text, predict_text in samples:
+            writer.write(source, line, image, text, predict_text)
+
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        for pages, (image_path, json_path) in enumerate(jobs, 1):
+            pending.append((image_path, executor.submit(extract_file, image_path, json_path, image_format)))
+            if len(pending) >= 2 * max(1, workers):
+                drain_one()
+            if pages % 1000 == 0:
+                print(f'{pages}/{len(account)} pages, {writer.samples} crops, '
+                      f'{writer.samples / (time.perf_counter() - start):.1f} crops/s')
+        while pending:
+            drain_one()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Export every textline crop of an account tree as sharded tar archives')
+    parser.add_argument('acc_dir', type=str, help='Directory where the images and their json files are located in')
+    parser.add_argument('out_dir', type=str, help='Where to write the shards and index.jsonl')
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--shard-size', type=int, default=10000, help='Crops per shard')
+    parser.add_argument('--format', choices=['png', 'jpg'], default='png', help='Encoding of the crops')
+    args = parser.parse_args()
+
+    account = Account(Path(args.acc_dir))
+    writer = ShardWriter(Path(args.out_dir), args.shard_size, args.format)
+    try:
+        export(account, writer, args.workers, args.format)
+    finally:
+        writer.close()
+    print(f'Exported {writer.samples} crops from {len(account)} pages into {writer.shard_id + 1} shards')
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def perspective_transforms(src: np.ndarray, dst: np.ndarray):
+    """Batched equivalent of `cv2.getPerspectiveTransform`.
+
+    `src` and `dst` are (N, 4, 2) arrays of corresponding corners. Returns the (N, 3, 3)
+    homographies and a boolean mask of the systems that could be solved; singular ones are
+    filled with NaN.
+    """
+    src = np.asarray(src, dtype=np.float64).reshape(-1, 4, 2)
+    dst = np.asarray(dst, dtype=np.float64).reshape(-1, 4, 2)
+    n = len(src)
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+
+    A = np.empty((n, 8, 8))
+    A[:, 0::2] = np.stack([x, y, ones, zeros, zeros, zeros, -x * u, -y * u], axis=-1)
+    A[:, 1::2] = np.stack([zeros, zeros, zeros, x, y, ones, -x * v, -y * v], axis=-1)
+    b = np.empty((n, 8))
+    b[:, 0::2] = u
+    b[:, 1::2] = v
+
+    transforms = np.full((n, 3, 3), np.nan)
+    ok = np.zeros(n, dtype=bool)
+    if n == 0:
+        return transforms, ok
+    try:
+        h = np.linalg.solve(A, b[..., None])[..., 0]
+        ok[:] = True
+    except np.linalg.LinAlgError:
+        # at least one system is singular, solve them one by one to find out which
+        h = np.full((n, 8), np.nan)
+        for i in range(n):
+            try:
+                h[i] = np.linalg.solve(A[i], b[i])
+                ok[i] = True
+            except np.linalg.LinAlgError:
+                pass
+    ok &= np.isfinite(h).all(axis=1)
+    transforms[ok, :, :] = np.concatenate([h[ok], np.ones((ok.sum(), 1))], axis=1).reshape(-1, 3, 3)
+    return transforms, ok
+
+
+# degeneracy of a quadrilateral, see `quad_degeneracy`
+QUAD_OK, QUAD_DUPLICATE_CORNERS, QUAD_COLLINEAR_CORNERS = 0, 1, 2
+QUAD_DEGENERACY_NAMES = {QUAD_DUPLICATE_CORNERS: 'duplicate corners', QUAD_COLLINEAR_CORNERS: 'collinear corners'}
+
+
+def order_quads(quads: np.ndarray) -> np.ndarray:
+    """Batched `order_points` of duplicate_region: corners of (N, 4, 2) quads as top-left, top-right,
+    bottom-right, bottom-left, picked by the extremes of x + y and y - x.
+    """
+    quads = np.asarray(quads, dtype=np.float32).reshape(-1, 4, 2)
+    s = quads.sum(axis=2)
+    diff = quads[..., 1] - quads[..., 0]
+    corners = np.stack([s.argmin(axis=1), diff.argmin(axis=1), s.argmax(axis=1), diff.argmax(axis=1)], axis=1)
+    return np.take_along_axis(quads, corners[..., None], axis=1)
+
+
+def quad_degeneracy(quads: np.ndarray, eps: float = 1e-6) -> np.ndarray:
+    """QUAD_* code of every (N, 4, 2) quad: two corners at the same place, or three on a line.
+
+    Either way the quad does not define a homography. Tolerances are relative to the quad's extent.
+    """
+    quads = np.asarray(quads, dtype=np.float64).reshape(-1, 4, 2)
+    extent = np.ptp(quads, axis=1).max(axis=1)
+    codes = np.full(len(quads), QUAD_OK, dtype=np.uint8)
+
+    distances = np.linalg.norm(quads[:, :, None] - quads[:, None, :], axis=-1)
+    distances[:, np.arange(4), np.arange(4)] = np.inf
+    duplicate = distances.min(axis=(1, 2)) <= eps * extent
+
+    collinear = np.zeros(len(quads), dtype=bool)
+    for a, b, c in ((0, 1, 2), (0, 1, 3), (0, 2, 3), (1, 2, 3)):
+        u, v = quads[:, b] - quads[:, a], quads[:, c] - quads[:, a]
+        area = np.abs(u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0])
+        collinear |= area <= eps * extent ** 2
+
+    codes[collinear] = QUAD_COLLINEAR_CORNERS
+    codes[duplicate] = QUAD_DUPLICATE_CORNERS
+    return codes
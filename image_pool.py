@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Tuple
+
+from crop_cache import image_nbytes
+
+
+class ImagePool():
+    """Shared LRU of decoded page images, bounded by a number of entries and a memory budget.
+
+    Pages are decoded into arrays when they enter the pool, so PIL closes their file right away
+    and an entry never holds a file descriptor besides the mapping of a memory-mapped array.
+    Evicted pages are simply loaded again by the next `get`.
+    """
+    def __init__(self, max_open: int = 32, max_bytes: int = 2 * 2**30):
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.loads = 0
+        self._items: 'OrderedDict[Hashable, Tuple[object, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: Hashable, load: Callable[[], object]):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                return item[0]
+
+        value = load()
+        nbytes = image_nbytes(value)
+        with self._lock:
+            self.loads += 1
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            # always keep the page just loaded, even when it alone exceeds the budget
+            while len(self._items) > 1 and (len(self._items) > self.max_open or self.nbytes > self.max_bytes):
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+        return value
+
+    def stats(self) -> str:
+        return f'pages {len(self._items)}/{self.max_open}, {self.nbytes / 2**20:.1f}MB, {self.loads} loads'
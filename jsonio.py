@@ -0,0 +1,36 @@
+"""JSON reading and writing shared by the scripts.
+
+orjson is used when it is installed, the standard library otherwise. Pretty output is always
+produced by the standard library (orjson can only indent by 2) so that it stays byte-identical
+to what labelme and the previous versions of the scripts write.
+"""
+import json
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load(path: Path):
+    return loads(Path(path).read_bytes())
+
+
+def dumps(obj, compact: bool = False) -> bytes:
+    """UTF-8 encoded JSON, on a single line when `compact`, indented by 4 otherwise."""
+    if not compact:
+        return json.dumps(obj, ensure_ascii=False, indent=4).encode('utf8')
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+
+def dump(obj, path: Path, compact: bool = False):
+    Path(path).write_bytes(dumps(obj, compact))
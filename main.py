@@ -3,26 +3,42 @@ import glob
 import json
 import os
 import sys
+import time
+from argparse import ArgumentParser
+from functools import partial
+from collections import OrderedDict
 from pathlib import Path
+from typing import List, Optional, Set, Tuple
 
 import cv2
 import numpy as np
 import pandas as pd
 from PIL import Image
 from PIL.ImageQt import ImageQt
-from PyQt5.QtCore import QEvent, QSize, Qt, pyqtSignal, qDebug
+from PyQt5.QtCore import (QEvent, QObject, QRect, QRunnable, QSize, Qt,
+                          QThreadPool, pyqtSignal, qDebug)
 from PyQt5.QtGui import (QColor, QFont, QFontMetrics, QGuiApplication, QImage,
                          QImageReader, QImageWriter, QIntValidator, QKeyEvent,
-                         QPainter, QPalette, QPixmap)
+                         QKeySequence, QPainter, QPalette, QPen, QPixmap)
 from PyQt5.QtWidgets import (QApplication, QHBoxLayout, QLabel, QLineEdit,
                              QMainWindow, QMessageBox, QPushButton, QGroupBox,
                              QScrollArea, QScrollBar, QShortcut, QSizePolicy,
                              QVBoxLayout, QWidget)
 
-WIN_SIZE = (1024, 128)
+from account import Account, AccountFile
+from crop_cache import CropCache, Prefetcher
+from disagreement import ReviewQueue, account_scores
+from image_pool import ImagePool
+from page_cache import PageCache
+from profiler import StageProfiler
+from saver import JsonSaver
+from shards import ShardSession, parse_shard
 
-def distance(p1, p2):
-    return np.linalg.norm(np.array(p1) - np.array(p2))
+WIN_SIZE = (1024, 128)
+TARGET_HEIGHT = 64
+# contact sheet layout, in pixels
+SHEET_MARKER_WIDTH = 12
+SHEET_PADDING = 6
 
 class SwitchSignal(QWidget):
 
@@ -38,68 +54,189 @@ class SwitchSignal(QWidget):
             print('KEy Down')
             self.next.emit()
 
-class Account():
-    def __init__(self, acc_dir: Path):
-        ext_list = ['jpg', 'jpeg', 'png']
-        ext_list.extend([x.upper() for x in ext_list])
-        ext_list = [f'**/*.{ext}' for ext in ext_list]
-
-        self.acc_images = sum([sorted(list(acc_dir.glob(pattern))) for pattern in ext_list], [])
-        self.acc_jsons = [image.with_suffix('.json') for image in self.acc_images]
-        self.accs = []
-        for image_path, json_path in zip(self.acc_images, self.acc_jsons):
-            acc_file = AccountFile(image_path, json_path)
-            if len(acc_file) > 0:
-                self.accs.append(acc_file)
-    
-    def __getitem__(self, idx):
-        return self.accs[idx]
-
-    def __len__(self):
-        return len(self.accs)
-
-
-class AccountFile():
-    def __init__(self, image_path: Path, json_path: Path):
-        self.image_path = image_path
-        self.json_path = json_path
-
-        self.image: Image.Image = Image.open(image_path)
-        self.textlines = json.load(open(json_path))
-        self.check_flags = [0] * len(self.textlines)
-
-    def __getitem__(self, idx):
-        obj = self.textlines[idx]
-        predict_text = obj['predict_text'].strip()
-        labling_text = obj['labling_text'].strip()
-        points = obj['coords']
 
-        if isinstance(points, list):
-            cv_image = np.array(self.image)
-            width = int(round((distance(points[0], points[1]) + distance(points[2], points[3])) / 2))
-            height = int(round((distance(points[0], points[3]) + distance(points[1], points[2])) / 2))
-
-            M = cv2.getPerspectiveTransform(np.float32(points), np.float32([[0, 0], [width, 0], [width, height], [0, height]]))
-            image = cv2.warpPerspective(cv_image, M, (width, height))
-
-            cur_tl_img = Image.fromarray(image)
-        elif isinstance(points, str):
-            points = points.strip()
-            x, y, w, h = [int(item) for item in points.split()]
-            cur_tl_img = self.image.crop((x, y, x + w, y + h))
-        else:
-            print('Unknow type of "coords"')
-            exit(-1)
-        return cur_tl_img, predict_text, labling_text
+def scale_array(array: np.ndarray, target_h: int = TARGET_HEIGHT) -> np.ndarray:
+    image_h, image_w = array.shape[:2]
+    if image_w * image_h == 0:
+        return array
+    factor = target_h / image_h
+    image_w = factor * image_w
+    image_h = factor * image_h
+    image_w, image_h = int(image_w), int(image_h)
+    interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR
+    return cv2.resize(array, (max(image_w, 1), max(image_h, 1)), interpolation=interpolation)
+
+
+def array_to_qimage(array: np.ndarray) -> QImage:
+    """QImage sharing the buffer of a C-contiguous uint8 gray, RGB or RGBA array, no pixel is copied.
+
+    The QImage does not own the buffer: the array must be kept alive as long as the QImage is used.
+    Other arrays are converted through PIL.
+    """
+    formats = {1: QImage.Format_Grayscale8, 3: QImage.Format_RGB888, 4: QImage.Format_RGBA8888}
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    if array.dtype != np.uint8 or channels not in formats:
+        return ImageQt(Image.fromarray(array))
+    if not array.flags['C_CONTIGUOUS']:
+        raise ValueError('array_to_qimage needs a C-contiguous array, see np.ascontiguousarray')
+    height, width = array.shape[:2]
+    return QImage(array.data, width, height, array.strides[0], formats[channels])
+
+
+def load_display_crop(acc_file: AccountFile, idx, profiler: Optional[StageProfiler] = None):
+    """Crop a textline and scale it for display, returns (image, predict_text, labling_text)."""
+    profiler = profiler or StageProfiler(enabled=False)
+    # lines at least twice as high as displayed are cropped from the half-size page when it is cached
+    level = 0
+    if acc_file.page_cache is not None and acc_file.geometry()[0][idx][1] >= 2 * TARGET_HEIGHT:
+        level = 1
+    with profiler.stage('crop'):
+        image = acc_file.crop_pixels(idx, level)
+        pred, label = acc_file.texts(idx)
+    with profiler.stage('resize'):
+        image = scale_array(image)
+    return image, pred, label
+
+
+class CropSignals(QObject):
+    """Signals of the CropTasks, emitted from a worker thread and delivered on the GUI thread.
+
+    `loaded` carries the list of (image, predict_text, labling_text) of the requested lines.
+    """
+    loaded = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+
+class SaverSignals(QObject):
+    """Write failures of the JsonSaver, emitted from its writer thread and delivered on the GUI thread."""
+    failed = pyqtSignal(str, str)
+
+
+class CropTask(QRunnable):
+    """Loads the display crops of some lines of an AccountFile on a QThreadPool thread.
+
+    Requests are numbered by the App; a task whose request is no longer the current one by the
+    time it starts is dropped without cropping anything.
+    """
+    def __init__(self, request_id: int, prefetcher: Prefetcher, acc_index: int, line_indices: List[int],
+                 signals: CropSignals, is_current):
+        super().__init__()
+        self.request_id = request_id
+        self.prefetcher = prefetcher
+        self.acc_index = acc_index
+        self.line_indices = line_indices
+        self.signals = signals
+        self.is_current = is_current
+
+    def run(self):
+        if not self.is_current(self.request_id):
+            return
+        items = []
+        for line_index in self.line_indices:
+            if not self.is_current(self.request_id):
+                return
+            try:
+                items.append(self.prefetcher.get(self.acc_index, line_index))
+            except Exception as e:
+                self.signals.failed.emit(self.request_id, f'{type(e).__name__}: {e}')
+                return
+        self.signals.loaded.emit(self.request_id, items)
+
+
+def render_contact_sheet(items, flags, selected: int, font: QFont) -> QImage:
+    """Compose the crops and texts of a page of textlines into one image, one cell per line.
+
+    `items` are (image, predict_text, labling_text) with images scaled by `scale_array`. Each cell has
+    a marker colored by its check flag (green correct, red not yet) and the selected one is framed.
+    """
+    metrics = QFontMetrics(font)
+    cell_h = TARGET_HEIGHT + 2 * metrics.height() + 3 * SHEET_PADDING
+    left = SHEET_MARKER_WIDTH + SHEET_PADDING
+    width = max([image.shape[1] for image, _, _ in items] + [WIN_SIZE[0] - left]) + left + SHEET_PADDING
+
+    sheet = QImage(width, cell_h * len(items), QImage.Format_RGB32)
+    sheet.fill(Qt.white)
+    painter = QPainter(sheet)
+    painter.setFont(font)
+    for i, (image, pred, label) in enumerate(items):
+        top = i * cell_h
+        painter.fillRect(0, top, SHEET_MARKER_WIDTH, cell_h, QColor(Qt.green if flags[i] else Qt.red))
+        # kept alive while it is drawn
+        image = np.ascontiguousarray(image)
+        painter.drawImage(left, top + SHEET_PADDING, array_to_qimage(image))
+        baseline = top + TARGET_HEIGHT + 2 * SHEET_PADDING + metrics.ascent()
+        painter.setPen(QColor(Qt.black))
+        painter.drawText(left, baseline, label)
+        painter.setPen(QColor(Qt.darkGray))
+        painter.drawText(left, baseline + metrics.height() + SHEET_PADDING, pred)
+        painter.setPen(QColor(Qt.lightGray))
+        painter.drawLine(0, top + cell_h - 1, width, top + cell_h - 1)
+    if 0 <= selected < len(items):
+        painter.setPen(QPen(QColor(Qt.blue), 3))
+        painter.drawRect(SHEET_MARKER_WIDTH + 1, selected * cell_h + 1, width - SHEET_MARKER_WIDTH - 3, cell_h - 3)
+    painter.end()
+    return sheet
+
+
+class FontFitter():
+    """Biggest point size in [min_size, max_size) at which a text fits a rect, memoized per (text, rect size).
+
+    On a cache miss the size is estimated from a single measurement at the largest size, since the
+    text extent grows about linearly with the point size, then corrected one point at a time.
+    """
+    def __init__(self, font: QFont, min_size: int = 1, max_size: int = 27, capacity: int = 4096):
+        self.font = QFont(font)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.capacity = capacity
+        self.cache: 'OrderedDict[Tuple[str, int, int], int]' = OrderedDict()
+
+    def fits(self, size: int, text: str, target_rect: QRect) -> bool:
+        self.font.setPointSize(size)
+        # Be careful which overload of boundingRect() you call.
+        rect = QFontMetrics(self.font).boundingRect(target_rect, Qt.AlignLeft, text)
+        return rect.width() <= target_rect.width() and rect.height() <= target_rect.height()
+
+    def fit(self, text: str, target_rect: QRect) -> int:
+        key = (text, target_rect.width(), target_rect.height())
+        size = self.cache.get(key)
+        if size is not None:
+            self.cache.move_to_end(key)
+            return size
+
+        size = self.estimate(text, target_rect)
+        self.cache[key] = size
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        return size
+
+    def estimate(self, text: str, target_rect: QRect) -> int:
+        largest = self.max_size - 1
+        self.font.setPointSize(largest)
+        rect = QFontMetrics(self.font).boundingRect(target_rect, Qt.AlignLeft, text)
+        if rect.width() <= target_rect.width() and rect.height() <= target_rect.height():
+            return largest
+
+        ratio = min(target_rect.width() / max(rect.width(), 1), target_rect.height() / max(rect.height(), 1))
+        size = min(max(int(largest * ratio), self.min_size), largest - 1)
+        while size > self.min_size and not self.fits(size, text, target_rect):
+            size -= 1
+        while size + 1 < largest and self.fits(size + 1, text, target_rect):
+            size += 1
+        return size
 
-    def __len__(self):
-        return len(self.textlines)
 
 class App(QMainWindow):
-    def __init__(self, acc_dir):
+    def __init__(self, acc_dir, profiler: Optional[StageProfiler] = None, page_cache: Optional[PageCache] = None,
+                 image_pool: Optional[ImagePool] = None, grid_size: int = 8, grid_mode: bool = False,
+                 shard: Optional[Tuple[int, int]] = None, state_path: Optional[Path] = None,
+                 rank: bool = False, min_cer: Optional[float] = None, cer_workers: int = 1):
         super().__init__()
 
+        self.profiler = profiler or StageProfiler(enabled=False)
+
         self.image = QImage()
+        self.image_array = None
         self.scaleFactor = 1.0
 
         self.imageLabel = QLabel()
@@ -195,9 +332,24 @@ class App(QMainWindow):
         self.incorrect_button.clicked.connect(self.on_incorrect_button_clicked)
         self.incorrect_button.setShortcut("2")
         button_layout.addWidget(self.incorrect_button)
+        self.accept_page_button = QPushButton('ĐÚNG CẢ TRANG')
+        pallete = self.accept_page_button.palette()
+        pallete.setColor(QPalette.Button, QColor(Qt.darkGreen))
+        self.accept_page_button.setFixedHeight(40)
+        self.accept_page_button.setPalette(pallete)
+        self.accept_page_button.clicked.connect(self.accept_page)
+        self.accept_page_button.setShortcut("3")
+        self.accept_page_button.setVisible(False)
+        button_layout.addWidget(self.accept_page_button)
         buttons.setLayout(button_layout)
         layout.addWidget(buttons)
 
+        # contact sheet mode: "G" switches modes, space toggles the selected line, PageUp/PageDown turn pages
+        QShortcut(QKeySequence('G'), self, self.toggle_grid_mode)
+        QShortcut(QKeySequence(Qt.Key_Space), self, self.toggle_selected_flag)
+        QShortcut(QKeySequence(Qt.Key_PageDown), self, self.next_page)
+        QShortcut(QKeySequence(Qt.Key_PageUp), self, self.prev_page)
+
         signal_widget = SwitchSignal()
         signal_widget.next.connect(self.next_image)
         signal_widget.prev.connect(self.prev_image)
@@ -211,31 +363,72 @@ class App(QMainWindow):
 
         self.current_index = 0
 
-        self.account = Account(acc_dir)
+        self.account = Account(acc_dir, page_cache=page_cache, image_pool=image_pool)
+        # a shard session records the flags in its state file, the sidecars are only written by a merge
+        self.session = None
+        if shard is not None:
+            self.session = ShardSession(self.account, shard[0], shard[1], state_path)
 
         if len(self.account) == 0:
             print('Nothing to do! Nice!')
             exit(0)
 
+        # lines are walked by descending CER instead of in file order, see disagreement.py
+        self.scores = None
+        self.review_queue: Optional[ReviewQueue] = None
+        self.queue_index = 0
+        if rank or min_cer is not None:
+            self.scores = account_scores(self.account, cer_workers)
+            self.review_queue = ReviewQueue(self.scores, min_cer)
+            print(f'{len(self.review_queue)} lines to review by descending CER')
+            if len(self.review_queue) == 0:
+                print('Nothing to do! Nice!')
+                exit(0)
+
         self.label_text.installEventFilter(self)
 
-        self.need_save = False
+        self.saver_signals = SaverSignals()
+        self.saver_signals.failed.connect(self.on_save_failed)
+        self.saver = JsonSaver(on_error=lambda path, error: self.saver_signals.failed.emit(str(path), error))
+        self.font_fitter = FontFitter(self.label_text.font())
+        self.prefetcher = Prefetcher(self.account, partial(load_display_crop, profiler=self.profiler), CropCache())
+        self.dirty_files: Set[AccountFile] = set()
+        # crops are loaded off the GUI thread, only the latest request is shown
+        self.thread_pool = QThreadPool()
+        self.thread_pool.setMaxThreadCount(1)
+        self.crop_signals = CropSignals()
+        self.crop_signals.loaded.connect(self.on_crop_loaded)
+        self.crop_signals.failed.connect(self.on_crop_failed)
+        self.request_id = 0
+        self.request_start = 0.
+        self.grid_size = max(1, grid_size)
+        self.grid_mode = False
+        self.page_lines: List[int] = []
+        self.page_items = None
+        self.selected = 0
+        self.sheet_font = QFont(self.label_text.font())
+        self.sheet_font.setPointSize(14)
         self.acc_file_index = 0
         self.current_account_file = self.account[0]
         self.total_acc_label.setText(f'{len(self.account) - 1:05d}')
         self.total_line_label.setText(f'{len(self.current_account_file) - 1:05d}')
-        self.set_step(0)
+        if grid_mode:
+            self.toggle_grid_mode()
+        elif self.review_queue is not None:
+            self.step_queue(0)
+        else:
+            self.set_step(0)
 
     def jump_to_line_index(self):
         step = int(self.current_line_index.text())
-        self.set_step(step)
+        self.show_page(step) if self.grid_mode else self.set_step(step)
     
     def jump_to_acc_file(self):
         acc_index = min(int(self.current_acc_index_label.text()), len(self.account) - 1)
         line_index = min(int(self.current_line_index.text()), len(self.account[acc_index]) - 1)
         self.acc_file_index = acc_index
         self.current_account_file = self.account[self.acc_file_index]
-        self.set_step(line_index)
+        self.show_page(line_index) if self.grid_mode else self.set_step(line_index)
 
     def eventFilter(self, source, event):
         if (event.type() == QEvent.KeyPress and source is self.label_text):
@@ -247,89 +440,263 @@ class App(QMainWindow):
 
     def next_image(self):
         self.save()
-        self.set_step(self.current_index + 1)
+        if self.review_queue is not None and not self.grid_mode:
+            self.step_queue(self.queue_index + 1)
+        elif not self.grid_mode:
+            self.set_step(self.current_index + 1)
+        elif self.selected + 1 < len(self.page_lines):
+            self.select_cell(self.selected + 1)
+        else:
+            self.next_page()
 
     def prev_image(self):
         self.save()
-        self.set_step(self.current_index - 1)
+        if self.review_queue is not None and not self.grid_mode:
+            self.step_queue(self.queue_index - 1, direction=-1)
+        elif not self.grid_mode:
+            self.set_step(self.current_index - 1, direction=-1)
+        elif self.selected > 0:
+            self.select_cell(self.selected - 1)
+        else:
+            self.prev_page()
 
     def on_correct_button_clicked(self):
-        self.current_account_file.check_flags[self.current_index] = 1
+        if self.current_account_file.set_flag(self.current_index, 1):
+            self.dirty_files.add(self.current_account_file)
         self.next_image()
 
     def on_incorrect_button_clicked(self):
-        self.current_account_file.check_flags[self.current_index] = 0
+        if self.current_account_file.set_flag(self.current_index, 0):
+            self.dirty_files.add(self.current_account_file)
         self.next_image()
 
-    def is_able_to_next(self, step):
-        if step >= len(self.current_account_file):
-            if self.acc_file_index == len(self.account) - 1:
-                return False
-        return True
-
-    def is_able_to_back(self, step):
-        if step < 0:
-            if self.acc_file_index == 0:
-                return False
-        return True
-
-    def set_step(self, step):
+    def find_valid_position(self, acc_index, line_index, direction):
+        """First textline with a non-empty crop at or after (direction=1) / before (direction=-1) a position."""
+        while 0 <= acc_index < len(self.account):
+            valid = self.account[acc_index].valid_indices()
+            if direction > 0:
+                k = np.searchsorted(valid, line_index, side='left')
+                if k < len(valid):
+                    return acc_index, int(valid[k])
+                acc_index, line_index = acc_index + 1, 0
+            else:
+                k = np.searchsorted(valid, line_index, side='right') - 1
+                if k >= 0:
+                    return acc_index, int(valid[k])
+                acc_index -= 1
+                line_index = len(self.account[acc_index]) - 1 if acc_index >= 0 else -1
+        return None
+
+    def step_position(self, step):
+        """Position of a step of the current file, moving into the next or previous file past its ends.
+
+        None when the step is past either end of the account.
+        """
+        acc_file_index = self.acc_file_index
         if step >= len(self.current_account_file):
-            if self.acc_file_index == len(self.account) - 1:
-                return
-            else:    
-                self.acc_file_index += 1
-            self.current_account_file = self.account[self.acc_file_index]
+            if acc_file_index == len(self.account) - 1:
+                return None
+            acc_file_index += 1
             step = 0
         elif step < 0:
-            if self.acc_file_index == 0:
+            if acc_file_index == 0:
+                return None
+            acc_file_index -= 1
+            step = len(self.account[acc_file_index]) - 1
+        return acc_file_index, step
+
+    def nearest_valid_position(self, acc_index, line_index, direction):
+        # empty crops are skipped up front, falling back to the other direction at either end of the account
+        position = (self.find_valid_position(acc_index, line_index, direction)
+                    or self.find_valid_position(acc_index, line_index, -direction))
+        if position is None:
+            self.finish()
+        return position
+
+    def finish(self):
+        print('Done!')
+        self.cancel_request()
+        self.save()
+        unsaved = self.saver.close()
+        self.prefetcher.shutdown()
+        exit(1 if unsaved else 0)
+
+    def set_step(self, step, direction=1):
+        start = time.perf_counter()
+        position = self.step_position(step)
+        if position is None:
+            return
+        position = self.nearest_valid_position(*position, direction)
+        if self.review_queue is not None:
+            queue_index = self.review_queue.index_of(*position)
+            self.queue_index = queue_index if queue_index is not None else self.queue_index
+        self.show_line(*position, start)
+
+    def step_queue(self, queue_index, direction=1):
+        """Show the queue_index-th line of the review queue, or the nearest one in `direction` with a crop."""
+        start = time.perf_counter()
+        while 0 <= queue_index < len(self.review_queue):
+            acc_index, line_index = self.review_queue[queue_index]
+            if self.account[acc_index].geometry()[0][line_index].min() > 0:
+                self.queue_index = queue_index
+                self.show_line(acc_index, line_index, start)
                 return
-            else:    
-                self.acc_file_index -= 1
-            self.current_account_file = self.account[self.acc_file_index]
-            step = len(self.current_account_file) - 1
+            queue_index += direction
 
+    def show_line(self, acc_index, step, start):
+        self.acc_file_index = acc_index
+        self.current_account_file = self.account[self.acc_file_index]
         self.current_index = step
-        image, pred, label = self.current_account_file[step]
-        if image.size[0] * image.size[1] == 0:
-            print(f'Width or height is 0. WxH = {image.size[0]}x{image.size[1]}')
-            if self.is_able_to_next(step):
-                self.next_image()
-                return
-            elif self.is_able_to_back(step):
-                self.prev_image()
-                return
-            else:
-                print('Done!')
-                exit(0)
+        pred, label = self.current_account_file.texts(step)
 
         self.current_line_index.setText(f'{self.current_index:05d}')
         self.current_acc_index_label.setText(f'{self.acc_file_index:05d}')
         self.total_line_label.setText(f'{len(self.current_account_file) - 1:05d}')
+        self.current_path_label.setText(str(self.current_account_file.image_path))
         self.pred_text.setText(pred)
         self.label_text.setText(label)
+        with self.profiler.stage('font'):
+            self.fit_font(label)
+
+        # the texts are shown right away, the crop when it is ready
+        self.cancel_request()
+        self.request_start = start
+        item = self.prefetcher.peek(self.acc_file_index, step)
+        if item is not None:
+            self.show_crop(item[0])
+        else:
+            self.imageLabel.clear()
+            self.thread_pool.start(CropTask(self.request_id, self.prefetcher, self.acc_file_index, [step],
+                                            self.crop_signals, self.is_current_request))
+        positions = None
+        if self.review_queue is not None:
+            positions = self.review_queue.neighbours(self.queue_index, self.prefetcher.ahead, self.prefetcher.behind)
+        self.prefetcher.schedule(self.acc_file_index, step, positions)
+        if self.profiler.enabled:
+            self.profiler.record('step', time.perf_counter() - start)
+
+    def cancel_request(self):
+        """Make the pending crop request stale, dropping it from the queue if it did not start yet."""
+        self.request_id += 1
+        self.thread_pool.clear()
+
+    def is_current_request(self, request_id: int) -> bool:
+        return request_id == self.request_id
+
+    def on_crop_loaded(self, request_id: int, items):
+        if request_id != self.request_id:
+            return
+        if self.grid_mode:
+            self.page_items = items
+            self.show_page_items()
+        else:
+            self.show_crop(items[0][0])
+
+    def on_crop_failed(self, request_id: int, error: str):
+        if request_id != self.request_id:
+            return
+        print(f'Could not crop line {self.current_index} of {self.current_account_file.image_path}: {error}')
+        self.statusBar().showMessage(f'Could not crop: {error}')
+
+    def show_crop(self, image: np.ndarray):
         self.loadImage(image)
+        if self.profiler.enabled:
+            self.profiler.record('display', time.perf_counter() - self.request_start)
+
+    def toggle_grid_mode(self):
+        self.grid_mode = not self.grid_mode
+        self.accept_page_button.setVisible(self.grid_mode)
+        if self.grid_mode:
+            self.show_page(self.current_index)
+        else:
+            self.scrollArea.setMinimumHeight(0)
+            self.set_step(self.current_index)
+
+    def show_page(self, step, direction=1):
+        """Show the `grid_size` valid textlines starting at (direction=1) / ending at (direction=-1) a step."""
+        start = time.perf_counter()
+        position = self.step_position(step)
+        if position is None:
+            return
+        acc_index, line_index = self.nearest_valid_position(*position, direction)
+        valid = self.account[acc_index].valid_indices()
+        k = int(np.searchsorted(valid, line_index))
+        lines = valid[k:k + self.grid_size] if direction > 0 else valid[max(0, k - self.grid_size + 1):k + 1]
 
-        #### Resize font
-        # Use binary search to efficiently find the biggest font that will fit.
-        max_size = 27
-        min_size = 1
-        font = self.label_text.font()
-        while 1 < max_size - min_size:
-            new_size = (min_size + max_size) // 2
-            font.setPointSize(new_size)
-            metrics = QFontMetrics(font)
-
-            target_rect = self.label_text.contentsRect()
-
-            # Be careful which overload of boundingRect() you call.
-            rect = metrics.boundingRect(target_rect, Qt.AlignLeft, label)
-            if (rect.width() > target_rect.width() or
-                    rect.height() > target_rect.height()):
-                max_size = new_size
-            else:
-                min_size = new_size
+        self.acc_file_index = acc_index
+        self.current_account_file = self.account[acc_index]
+        self.page_lines = [int(i) for i in lines]
+        self.page_items = None
+        self.current_acc_index_label.setText(f'{self.acc_file_index:05d}')
+        self.total_line_label.setText(f'{len(self.current_account_file) - 1:05d}')
+        self.current_path_label.setText(str(self.current_account_file.image_path))
+
+        self.cancel_request()
+        self.request_start = start
+        items = [self.prefetcher.peek(acc_index, i) for i in self.page_lines]
+        self.select_cell(0 if direction > 0 else len(self.page_lines) - 1)
+        if all(item is not None for item in items):
+            self.page_items = items
+            self.show_page_items()
+        else:
+            self.imageLabel.clear()
+            self.thread_pool.start(CropTask(self.request_id, self.prefetcher, acc_index, self.page_lines,
+                                            self.crop_signals, self.is_current_request))
+        self.prefetcher.schedule(acc_index, self.page_lines[-1])
+        if self.profiler.enabled:
+            self.profiler.record('page', time.perf_counter() - start)
+
+    def next_page(self):
+        if self.grid_mode:
+            self.save()
+            self.show_page(self.page_lines[-1] + 1)
+
+    def prev_page(self):
+        if self.grid_mode:
+            self.save()
+            self.show_page(self.page_lines[0] - 1, direction=-1)
+
+    def select_cell(self, cell):
+        self.selected = cell
+        self.current_index = self.page_lines[cell]
+        pred, label = self.current_account_file.texts(self.current_index)
+        self.current_line_index.setText(f'{self.current_index:05d}')
+        self.pred_text.setText(pred)
+        self.label_text.setText(label)
+        self.fit_font(label)
+        self.show_page_items()
+
+    def show_page_items(self):
+        """Render the page as a contact sheet, once its crops are loaded."""
+        if self.page_items is None:
+            return
+        flags = self.current_account_file.check_flags[self.page_lines]
+        with self.profiler.stage('sheet'):
+            sheet = render_contact_sheet(self.page_items, flags, self.selected, self.sheet_font)
+        self.scrollArea.setMinimumHeight(min(sheet.height() + 2, 600))
+        self.show_qimage(sheet)
+        cell_h = sheet.height() // len(self.page_items)
+        self.scrollArea.ensureVisible(0, self.selected * cell_h + cell_h // 2, 0, cell_h // 2)
+
+    def toggle_selected_flag(self):
+        if not self.grid_mode:
+            return
+        value = 1 - int(self.current_account_file.check_flags[self.current_index])
+        if self.current_account_file.set_flag(self.current_index, value):
+            self.dirty_files.add(self.current_account_file)
+        self.show_page_items()
+
+    def accept_page(self):
+        """Mark every line of the page as correct and turn to the next page."""
+        for line_index in self.page_lines:
+            if self.current_account_file.set_flag(line_index, 1):
+                self.dirty_files.add(self.current_account_file)
+        self.next_page()
+
+    def fit_font(self, label):
+        min_size = self.font_fitter.fit(label, self.label_text.contentsRect())
 
+        font = self.label_text.font()
         font.setPointSize(min_size)
         self.label_text.setFont(font)
 
@@ -337,25 +704,32 @@ class App(QMainWindow):
         pred_font.setPointSize(min_size)
         self.pred_text.setFont(pred_font)
 
-    def loadImage(self, pillow_image: Image.Image):
-        image_w, image_h = pillow_image.size
-        target_h = 64
-        factor = target_h / image_h
-        image_w = factor * image_w
-        image_h = factor * image_h
-        image_w, image_h = int(image_w), int(image_h)
-        pillow_image = pillow_image.resize((image_w, image_h))
+    def loadImage(self, array: np.ndarray):
+        """Show a crop already scaled by `scale_array`."""
+        with self.profiler.stage('qimage'):
+            # the QImage wraps the array, which is kept alive with it
+            self.image_array = np.ascontiguousarray(array)
+            image = array_to_qimage(self.image_array)
+        return self.show_qimage(image)
 
+    def show_qimage(self, image: QImage):
         self.scrollArea.setVisible(True)
-        self.image = ImageQt(pillow_image)
+        self.image = image
         self.imageLabel.setPixmap(QPixmap.fromImage(self.image))
-        self.imageLabel.setFixedSize(image_w, image_h)
-        
+        self.imageLabel.setFixedSize(self.image.width(), self.image.height())
+
         self.adjustScrollBar(self.scrollArea.horizontalScrollBar(), 0)
         self.adjustScrollBar(self.scrollArea.verticalScrollBar(), 1.0)
 
-        self.current_path_label.setText(str(self.current_account_file.image_path))
-        message = "{}, {}x{}, Depth: {}".format(self.current_account_file.image_path, self.image.width(), self.image.height(), self.image.depth())
+        message = "{}, {}x{}, Depth: {}, {}".format(self.current_account_file.image_path, self.image.width(), self.image.height(), self.image.depth(), self.prefetcher.cache.stats())
+        message += ', ' + self.account.image_pool.stats()
+        if self.scores is not None:
+            message += f', CER {self.scores[self.acc_file_index][self.current_index]:.2f}'
+        if self.profiler.enabled:
+            message += ', ' + self.profiler.summary()
+        unsaved = len(self.saver.failures())
+        if unsaved:
+            message += f', {unsaved} files not saved'
         self.statusBar().showMessage(message)
         return True
 
@@ -365,18 +739,61 @@ class App(QMainWindow):
 
     def save(self):
         acc_file: AccountFile
-        for acc_file in self.account:
-            textline_incorrect = []
-            for i, (flag, line) in enumerate(zip(acc_file.check_flags, acc_file.textlines)):
-                if flag == 0:
-                    textline_incorrect.append(line)
-            save_path = acc_file.json_path
-            json.dump(textline_incorrect, open(save_path, 'wt'))
+        with self.profiler.stage('save'):
+            for acc_file in self.dirty_files:
+                if self.session is not None:
+                    self.saver.submit(self.session.path, self.session.record(acc_file))
+                else:
+                    self.saver.submit(acc_file.json_path, acc_file.incorrect_textlines())
+            self.dirty_files.clear()
+
+    def on_save_failed(self, path: str, error: str):
+        self.statusBar().showMessage(f'Could not save {path}: {error}')
+
+    def closeEvent(self, event):
+        self.cancel_request()
+        self.thread_pool.waitForDone()
+        self.save()
+        self.saver.close()
+        self.prefetcher.shutdown()
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('acc_dir', type=str, help='Directory where the images and their json files are located in')
+    parser.add_argument('--profile', action='store_true', help='Show per-stage latencies in the status bar')
+    parser.add_argument('--profile-out', type=str, default=None,
+                        help='Dump the latency samples on exit, as .csv (raw) or .json (percentiles)')
+    parser.add_argument('--page-cache', type=str, default=None,
+                        help='Directory where decoded pages are cached for memory-mapped access')
+    parser.add_argument('--page-cache-size', type=float, default=16, help='Size limit of the page cache in GB')
+    parser.add_argument('--max-pages', type=int, default=32, help='Decoded pages kept in memory at most')
+    parser.add_argument('--pages-memory', type=float, default=2, help='Memory budget of the decoded pages in GB')
+    parser.add_argument('--grid', action='store_true',
+                        help='Start in contact sheet mode, reviewing a page of textlines per screen ("G" toggles it)')
+    parser.add_argument('--grid-size', type=int, default=8, help='Textlines per contact sheet page')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Review only shard K/N of the files, recording the flags in a state file (see shards.py)')
+    parser.add_argument('--shard-state', type=str, default=None,
+                        help='State file of the shard, defaults to .checkdata_shard-K-of-N.json in acc_dir')
+    parser.add_argument('--rank', action='store_true',
+                        help='Walk the textlines by descending character error rate between prediction and label')
+    parser.add_argument('--min-cer', type=float, default=None,
+                        help='Only review the textlines with a character error rate above this, implies --rank')
+    parser.add_argument('--cer-workers', type=int, default=os.cpu_count(), help='Processes computing the error rates')
+    args = parser.parse_args()
+
+    profiler = StageProfiler(enabled=args.profile or args.profile_out is not None)
+    page_cache = None
+    if args.page_cache is not None:
+        page_cache = PageCache(Path(args.page_cache), int(args.page_cache_size * 2**30))
+    image_pool = ImagePool(args.max_pages, int(args.pages_memory * 2**30))
     app = QApplication([])
-    window = App(Path(sys.argv[1]))
+    window = App(Path(args.acc_dir), profiler, page_cache, image_pool, args.grid_size, args.grid,
+                 args.shard, args.shard_state, args.rank, args.min_cer, args.cer_workers)
     window.show()
     # window.fixedText.setFocus()
     app.exec_()
+    if args.profile_out is not None:
+        profiler.dump(Path(args.profile_out))
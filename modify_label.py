@@ -1,22 +1,84 @@
-import json
+import multiprocessing
 from argparse import ArgumentParser
 from pathlib import Path
+from typing import Dict
 
 import yaml
 
+import jsonio
+
+
+def modify_file(json_path: Path, rename: Dict[str, str], compact: bool = False) -> Dict[str, int]:
+    """Rename the labels of one labelme file, return the number of shapes renamed per rule.
+
+    The file is rewritten only when at least one label changed.
+    """
+    json_dict = jsonio.load(json_path)
+    renamed: Dict[str, int] = {}
+    for shape in json_dict['shapes']:
+        new_label = rename.get(shape['label'], shape['label'])
+        if new_label != shape['label']:
+            renamed[shape['label']] = renamed.get(shape['label'], 0) + 1
+            shape['label'] = new_label
+    if renamed:
+        jsonio.dump(json_dict, json_path, compact)
+    return renamed
+
+
+def _modify_file_safe(job):
+    json_path, rename, compact = job
+    try:
+        return json_path, modify_file(json_path, rename, compact), None
+    except Exception as e:
+        return json_path, {}, f'{type(e).__name__}: {e}'
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument('modify_config', type=str, help='YAML file defines configuration dictionary')
     parser.add_argument('input_dir', type=str, help='Directory where the json files are located in')
+    parser.add_argument('--recursive', '-r', action='store_true', help='Also process the json files of sub directories')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--compact', action='store_true', help='Write json on a single line instead of indented')
     args = parser.parse_args()
 
     modify_config = yaml.safe_load(open(args.modify_config, 'rt'))
-    json_paths = Path(args.input_dir).glob(f'*.json')
-    for json_path in json_paths:
-        print('-' * 30)
-        print(f'Processing {json_path}')
-        json_dict = json.load(open(json_path, 'rt'))
-        for shape in json_dict['shapes']:
-            shape['label'] = modify_config['rename'].get(shape['label'], shape['label'])
-        json.dump(json_dict, open(json_path, 'wt', encoding='utf8'), ensure_ascii=False, indent=4)
+    rename = modify_config['rename']
+    pattern = '**/*.json' if args.recursive else '*.json'
+    # hidden json files are the bookkeeping of the other scripts (manifests, indexes, ...), not labelme files
+    jobs = ((json_path, rename, args.compact) for json_path in Path(args.input_dir).glob(pattern)
+            if not json_path.name.startswith('.'))
+
+    files, changed_files = 0, 0
+    renamed_total: Dict[str, int] = {}
+    renamed_files: Dict[str, int] = {}
+    failures = []
+    # in process by default, a pool is only worth it for many files
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    if pool is None:
+        results = map(_modify_file_safe, jobs)
+    else:
+        results = pool.imap_unordered(_modify_file_safe, jobs, chunksize=64)
+    try:
+        for json_path, renamed, error in results:
+            files += 1
+            if error is not None:
+                print(f'Failed to process {json_path}: {error}')
+                failures.append(json_path)
+                continue
+            if renamed:
+                changed_files += 1
+                print(f'Modified {json_path}: {renamed}')
+            for label, count in renamed.items():
+                renamed_total[label] = renamed_total.get(label, 0) + count
+                renamed_files[label] = renamed_files.get(label, 0) + 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    print('-' * 30)
+    print(f'{files} files, {changed_files} modified, {len(failures)} failed')
+    for label, count in sorted(renamed_total.items()):
+        print(f'{label} -> {rename[label]}: {count} shapes in {renamed_files[label]} files')
+    if failures:
+        exit(1)
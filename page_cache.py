@@ -0,0 +1,119 @@
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# bumped when the decoded pixels change, so that older entries are not used
+PAGE_CACHE_VERSION = 2
+
+
+def display_mode(image: Image.Image) -> str:
+    """Mode a page is decoded to: gray, RGB or RGBA, whatever it is stored as (palette, CMYK, ...)."""
+    if image.mode in ('L', 'RGB', 'RGBA'):
+        return image.mode
+    if image.mode == '1':
+        return 'L'
+    if image.mode in ('LA', 'La', 'PA', 'RGBa') or 'transparency' in image.info:
+        return 'RGBA'
+    return 'RGB'
+
+
+def to_display_mode(image: Image.Image) -> Image.Image:
+    mode = display_mode(image)
+    return image if image.mode == mode else image.convert(mode)
+
+
+def decode_page(image_path: Path) -> np.ndarray:
+    with Image.open(image_path) as image:
+        return np.array(to_display_mode(image))
+
+
+class PageCache():
+    """On-disk cache of decoded pages stored as raw .npy files and opened with `np.memmap`.
+
+    Entries are keyed by image path, mtime and size, so an edited image is decoded again.
+    Level 0 is the full page and level 1 the page downscaled by 2. Files are evicted least
+    recently used first (by mtime, bumped on every hit) once the cache exceeds `max_bytes`.
+    """
+    LEVELS = (0, 1)
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 16 * 2**30):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.nbytes = sum(path.stat().st_size for path in self.cache_dir.glob('*.npy'))
+
+    def key(self, image_path: Path) -> str:
+        stat = os.stat(image_path)
+        identity = f'{PAGE_CACHE_VERSION}:{Path(image_path).resolve()}:{stat.st_mtime_ns}:{stat.st_size}'
+        return hashlib.sha1(identity.encode('utf8')).hexdigest()
+
+    def entry_path(self, key: str, level: int) -> Path:
+        return self.cache_dir / f'{key}_{level}.npy'
+
+    def get(self, image_path: Path, level: int = 0) -> np.ndarray:
+        """The decoded page as a read-only memory-mapped array, decoding it on the first request."""
+        assert level in self.LEVELS
+        key = self.key(image_path)
+        path = self.entry_path(key, level)
+        try:
+            array = np.load(path, mmap_mode='r')
+            os.utime(path)
+            return array
+        except (FileNotFoundError, ValueError):
+            pass
+
+        page = decode_page(image_path)
+        levels = [page, cv2.resize(page, (max(1, page.shape[1] // 2), max(1, page.shape[0] // 2)),
+                                   interpolation=cv2.INTER_AREA)]
+        for lvl, array in zip(self.LEVELS, levels):
+            self._write(self.entry_path(key, lvl), array)
+        self.evict()
+        try:
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            # evicted right away, the cache is smaller than a single page
+            return levels[level]
+
+    def _write(self, path: Path, array: np.ndarray):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self.nbytes += path.stat().st_size
+
+    def evict(self):
+        with self._lock:
+            if self.nbytes <= self.max_bytes:
+                return
+            entries = []
+            for path in self.cache_dir.glob('*.npy'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+            entries.sort()
+            self.nbytes = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if self.nbytes <= self.max_bytes:
+                    break
+                # a page mapped by a reader stays readable after unlink on POSIX
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                self.nbytes -= size
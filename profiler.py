@@ -0,0 +1,79 @@
+import csv
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Deque, Dict, List, Tuple
+
+import numpy as np
+
+
+class StageProfiler():
+    """Opt-in latency samples per named stage, keeping a rolling window for percentiles.
+
+    Every sample is also kept in `history` so that a whole session can be dumped on exit.
+    When disabled, `stage` returns a no-op context manager.
+    """
+    def __init__(self, enabled: bool = True, window: int = 200):
+        self.enabled = enabled
+        self.window = window
+        self.samples: Dict[str, Deque[float]] = {}
+        self.history: List[Tuple[float, str, float]] = []
+        self._lock = threading.Lock()
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(seconds)
+            self.history.append((time.time(), name, seconds))
+
+    def percentiles(self, name: str, qs=(50, 95, 99)) -> List[float]:
+        """Percentiles in milliseconds over the rolling window of a stage."""
+        with self._lock:
+            samples = list(self.samples.get(name, ()))
+        if len(samples) == 0:
+            return [0.] * len(qs)
+        return (np.percentile(samples, qs) * 1000).tolist()
+
+    def summary(self) -> str:
+        parts = []
+        for name in list(self.samples):
+            p50, p95 = self.percentiles(name, (50, 95))
+            parts.append(f'{name} {p50:.1f}/{p95:.1f}ms')
+        return 'p50/p95: ' + ', '.join(parts) if parts else ''
+
+    def dump(self, path: Path):
+        """Write every sample as .csv, or the per-stage percentiles as .json."""
+        path = Path(path)
+        with self._lock:
+            history = list(self.history)
+        if path.suffix == '.csv':
+            with open(path, 'wt', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['time', 'stage', 'ms'])
+                for timestamp, name, seconds in history:
+                    writer.writerow([f'{timestamp:.6f}', name, f'{seconds * 1000:.3f}'])
+        else:
+            stages = {}
+            for name in sorted({name for _, name, _ in history}):
+                samples = np.array([seconds for _, stage, seconds in history if stage == name]) * 1000
+                p50, p95, p99 = np.percentile(samples, (50, 95, 99)).tolist()
+                stages[name] = {'count': len(samples), 'mean_ms': float(samples.mean()),
+                                'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': float(samples.max())}
+            json.dump(stages, open(path, 'wt'), indent=4)
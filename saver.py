@@ -0,0 +1,126 @@
+import os
+import stat
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import jsonio
+
+
+# os.umask can only be read by setting it, which would race with files created by other threads,
+# so it is read once on import, from the main thread
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def atomic_write_json(path: Path, obj, compact: bool = True):
+    """Dump `obj` to a temporary file next to `path`, then rename it over `path`.
+
+    A crash in the middle of writing leaves the old file untouched instead of a truncated one.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(jsonio.dumps(obj, compact))
+            f.flush()
+            os.fsync(f.fileno())
+        if path.exists():
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        else:
+            # mkstemp creates the file readable by its owner only, a new file gets the usual permissions
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class JsonSaver():
+    """Writes JSON files on a background thread.
+
+    Writes are coalesced by path: if a file is submitted again before the writer
+    got to it, only the latest content is written. A failed write is kept and retried
+    with the next submission, or on `close`, unless newer content replaced it;
+    `on_error(path, message)` is called from the writer thread when a write fails.
+    """
+    def __init__(self, compact: bool = True, on_error: Optional[Callable[[Path, str], None]] = None):
+        self.compact = compact
+        self.on_error = on_error
+        self._pending: Dict[Path, object] = {}
+        # content and error of the writes that failed, until they succeed
+        self._failed: Dict[Path, object] = {}
+        self._errors: Dict[Path, str] = {}
+        self._writing = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='json-saver', daemon=True)
+        self._thread.start()
+
+    def submit(self, path: Path, obj):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('JsonSaver is closed')
+            self._requeue_failed()
+            self._pending[Path(path)] = obj
+            self._cond.notify_all()
+
+    def failures(self) -> Dict[Path, str]:
+        """Error of every file whose latest write failed."""
+        with self._cond:
+            return dict(self._errors)
+
+    def _requeue_failed(self):
+        for path, obj in self._failed.items():
+            self._pending.setdefault(path, obj)
+        self._failed.clear()
+
+    def flush(self):
+        """Block until every submitted file has been written."""
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+
+    def close(self) -> Dict[Path, str]:
+        """Write what is pending, retrying the failed writes once, and stop the writer.
+
+        Returns the error of every file that could not be written.
+        """
+        with self._cond:
+            self._closed = True
+            self._requeue_failed()
+            self._cond.notify_all()
+        self._thread.join()
+        for path, error in self._errors.items():
+            print(f'Not saved {path}: {error}')
+        return dict(self._errors)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                path = next(iter(self._pending))
+                obj = self._pending.pop(path)
+                self._writing += 1
+            error = None
+            try:
+                atomic_write_json(path, obj, self.compact)
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                print(f'Failed to save {path}: {error}')
+            with self._cond:
+                self._writing -= 1
+                if error is None:
+                    self._errors.pop(path, None)
+                else:
+                    self._errors[path] = error
+                    if path not in self._pending:
+                        self._failed[path] = obj
+                self._cond.notify_all()
+            if error is not None and self.on_error is not None:
+                self.on_error(path, error)
@@ -0,0 +1,158 @@
+"""Split an Account between several reviewers and merge their sessions back into the sidecars.
+
+Every reviewer runs `main.py acc_dir --shard K/N`: the App then only walks the files of shard K
+and records the check flags in a state file of its own instead of rewriting the sidecars, so
+reviewers sharing a directory never write the same file. `python shards.py merge acc_dir` then
+drops the lines checked in every state file from the sidecars, as the App does in a single session.
+"""
+import heapq
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import jsonio
+from account import Account, AccountFile
+from saver import atomic_write_json
+
+SHARD_STATE_VERSION = 1
+
+
+def split_shards(line_counts: List[int], shards: int) -> List[List[int]]:
+    """File indices of every shard, balanced by textline count.
+
+    Files are assigned largest first to the shard with the fewest lines so far, ties broken by
+    index, so the split only depends on the line counts. Each shard keeps its files in order.
+    """
+    totals = [(0, k) for k in range(shards)]
+    assignment: List[List[int]] = [[] for _ in range(shards)]
+    for idx in sorted(range(len(line_counts)), key=lambda i: (-line_counts[i], i)):
+        total, k = heapq.heappop(totals)
+        assignment[k].append(idx)
+        heapq.heappush(totals, (total + line_counts[idx], k))
+    return [sorted(files) for files in assignment]
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """(shard, shards) from "K/N", with shards numbered from 0."""
+    shard, shards = (int(item) for item in text.split('/'))
+    if not 0 <= shard < shards:
+        raise ValueError(f'shard {shard} out of range for {shards} shards')
+    return shard, shards
+
+
+def shard_state_path(acc_dir: Path, shard: int, shards: int) -> Path:
+    return Path(acc_dir) / f'.checkdata_shard-{shard}-of-{shards}.json'
+
+
+class ShardSession():
+    """Check flags of one shard of an Account, kept in a per-shard state file.
+
+    Restricts `account` to the files of the shard and restores the flags of a previous session.
+    The lines checked in a file are stored under the sidecar's relative path, along with the
+    sidecar's mtime and size at the time of the review, so that a merge can refuse to apply them
+    to a sidecar that changed since.
+    """
+    def __init__(self, account: Account, shard: int, shards: int, state_path: Optional[Path] = None):
+        self.account = account
+        self.shard = shard
+        self.shards = shards
+        self.path = Path(state_path) if state_path is not None else shard_state_path(account.acc_dir, shard, shards)
+        self.files: Dict[str, dict] = self.load()
+        account.select_files(split_shards(account.line_counts, shards)[shard])
+        self.indices: Dict[Path, int] = {json_path: idx for idx, json_path in enumerate(account.acc_jsons)}
+        self.restore()
+
+    def load(self) -> Dict[str, dict]:
+        if not self.path.exists():
+            return {}
+        state = jsonio.load(self.path)
+        if (state.get('version') != SHARD_STATE_VERSION
+                or (state['shard'], state['shards']) != (self.shard, self.shards)):
+            raise ValueError(f'{self.path} is not a state of shard {self.shard}/{self.shards}')
+        return state['files']
+
+    def rel_path(self, idx: int) -> str:
+        return self.account.acc_jsons[idx].relative_to(self.account.acc_dir).as_posix()
+
+    def restore(self):
+        for idx, entry in enumerate(self.account.file_entries):
+            saved = self.files.get(self.rel_path(idx))
+            if saved is None:
+                continue
+            if (saved['json_mtime'], saved['json_size']) != (entry['json_mtime'], entry['json_size']):
+                print(f'{self.rel_path(idx)} changed since it was reviewed, its flags are reset')
+                del self.files[self.rel_path(idx)]
+                continue
+            self.account[idx].check_flags[saved['checked']] = 1
+
+    def record(self, acc_file: AccountFile) -> dict:
+        """Store the flags of a file, return a snapshot of the whole state to be written."""
+        idx = self.indices[acc_file.json_path]
+        entry = self.account.file_entries[idx]
+        self.files[self.rel_path(idx)] = {
+            'json_mtime': entry['json_mtime'],
+            'json_size': entry['json_size'],
+            'checked': np.flatnonzero(acc_file.check_flags).tolist(),
+        }
+        return {'version': SHARD_STATE_VERSION, 'shard': self.shard, 'shards': self.shards, 'files': dict(self.files)}
+
+
+def merge(acc_dir: Path, state_paths: List[Path], compact: bool = True) -> Tuple[int, int]:
+    """Drop the checked lines of every state from the sidecars, return (files written, lines dropped).
+
+    A sidecar changed since it was reviewed, or claimed by several states, is left untouched.
+    """
+    claims: Dict[str, List[Tuple[Path, dict]]] = {}
+    for state_path in state_paths:
+        state = jsonio.load(state_path)
+        if state.get('version') != SHARD_STATE_VERSION:
+            print(f'Skip {state_path}: unsupported version {state.get("version")}')
+            continue
+        for rel_path, saved in state['files'].items():
+            claims.setdefault(rel_path, []).append((state_path, saved))
+
+    written, dropped = 0, 0
+    for rel_path, file_claims in claims.items():
+        if len(file_claims) > 1:
+            print(f'Skip {rel_path}: reviewed in {", ".join(str(state_path) for state_path, _ in file_claims)}')
+            continue
+        _, saved = file_claims[0]
+        json_path = Path(acc_dir) / rel_path
+        stat = json_path.stat()
+        if (saved['json_mtime'], saved['json_size']) != (stat.st_mtime_ns, stat.st_size):
+            print(f'Skip {rel_path}: changed since it was reviewed (already merged?)')
+            continue
+        if not saved['checked']:
+            continue
+        textlines = jsonio.load(json_path)
+        checked = set(saved['checked'])
+        atomic_write_json(json_path, [line for i, line in enumerate(textlines) if i not in checked], compact)
+        written += 1
+        dropped += len(checked)
+    return written, dropped
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    split_parser = subparsers.add_parser('split', help='Show the files and lines of every shard')
+    split_parser.add_argument('acc_dir', type=str, help='Directory of the images and their json files')
+    split_parser.add_argument('shards', type=int, help='Number of shards')
+    merge_parser = subparsers.add_parser('merge', help='Apply the shard states to the json files')
+    merge_parser.add_argument('acc_dir', type=str, help='Directory of the images and their json files')
+    merge_parser.add_argument('states', nargs='*', help='Shard state files, defaults to every state in acc_dir')
+    merge_parser.add_argument('--indent', action='store_true', help='Write indented json instead of a single line')
+    args = parser.parse_args()
+
+    acc_dir = Path(args.acc_dir)
+    if args.command == 'split':
+        account = Account(acc_dir)
+        for shard, files in enumerate(split_shards(account.line_counts, args.shards)):
+            lines = sum(account.line_counts[idx] for idx in files)
+            print(f'shard {shard}/{args.shards}: {len(files)} files, {lines} lines')
+    else:
+        states = [Path(path) for path in args.states] or sorted(acc_dir.glob('.checkdata_shard-*-of-*.json'))
+        written, dropped = merge(acc_dir, states, compact=not args.indent)
+        print(f'Merged {len(states)} states: {dropped} lines dropped from {written} files')
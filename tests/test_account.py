@@ -0,0 +1,78 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from account import Account, AccountFile
+from image_pool import ImagePool
+from page_cache import PageCache
+
+
+def make_account(acc_dir, files=50, lines=3):
+    for i in range(files):
+        Image.fromarray(np.zeros((32, 64, 3), dtype=np.uint8)).save(acc_dir / f'p{i:03d}.png')
+        textlines = [{'coords': f'{j} {j} 10 8', 'predict_text': f'pred {j}', 'labling_text': f'label {j}'}
+                     for j in range(lines)]
+        (acc_dir / f'p{i:03d}.json').write_text(json.dumps(textlines))
+
+
+def test_getitem_creates_one_file_per_index_across_threads(tmp_path):
+    make_account(tmp_path)
+    account = Account(tmp_path)
+    workers = 4
+    barrier = threading.Barrier(workers)
+    seen = [[] for _ in range(workers)]
+
+    def walk(k):
+        for idx in range(len(account)):
+            barrier.wait()
+            seen[k].append(account[idx])
+
+    threads = [threading.Thread(target=walk, args=(k,)) for k in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for idx in range(len(account)):
+        assert all(files[idx] is account[idx] for files in seen)
+
+
+def test_flags_survive_concurrent_first_access(tmp_path):
+    make_account(tmp_path, files=20)
+    account = Account(tmp_path)
+    barrier = threading.Barrier(2)
+
+    def flag_all():
+        for idx in range(len(account)):
+            barrier.wait()
+            account[idx].set_flag(0, 1)
+
+    def read_all():
+        for idx in range(len(account)):
+            barrier.wait()
+            account[idx]
+
+    threads = [threading.Thread(target=flag_all), threading.Thread(target=read_all)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(acc_file.check_flags[0] == 1 for acc_file in account)
+
+
+@pytest.mark.parametrize('mode, name', [('P', 'page.png'), ('CMYK', 'page.jpg')])
+def test_pages_are_decoded_to_rgb(tmp_path, mode, name):
+    rgb = np.zeros((32, 64, 3), dtype=np.uint8)
+    rgb[:, :, 0] = 200
+    Image.fromarray(rgb).convert(mode).save(tmp_path / name)
+    (tmp_path / 'page.json').write_text(json.dumps([{'coords': '0 0 10 8', 'predict_text': 'a', 'labling_text': 'a'}]))
+
+    for page_cache in (None, PageCache(tmp_path / 'cache')):
+        acc_file = AccountFile(tmp_path / name, tmp_path / 'page.json', page_cache, ImagePool())
+        assert acc_file.array.shape == (32, 64, 3)
+        assert abs(int(acc_file.array[0, 0, 0]) - 200) <= 8
+        assert acc_file.crop(0).mode == 'RGB'
@@ -0,0 +1,28 @@
+import jsonio
+from saver import JsonSaver
+
+
+def test_failed_write_is_retried_with_the_next_submission(tmp_path):
+    errors = []
+    saver = JsonSaver(on_error=lambda path, error: errors.append(path))
+    missing = tmp_path / 'missing' / 'a.json'
+    saver.submit(missing, [1])
+    saver.flush()
+    assert errors == [missing]
+    assert list(saver.failures()) == [missing]
+
+    missing.parent.mkdir()
+    saver.submit(tmp_path / 'b.json', [2])
+    saver.flush()
+    assert jsonio.load(missing) == [1]
+    assert saver.failures() == {}
+    assert saver.close() == {}
+
+
+def test_close_reports_the_writes_that_never_succeeded(tmp_path):
+    saver = JsonSaver()
+    missing = tmp_path / 'missing' / 'a.json'
+    saver.submit(missing, [1])
+    saver.submit(tmp_path / 'b.json', [2])
+    assert list(saver.close()) == [missing]
+    assert jsonio.load(tmp_path / 'b.json') == [2]
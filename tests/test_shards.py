@@ -0,0 +1,24 @@
+import json
+
+import jsonio
+from shards import SHARD_STATE_VERSION, merge
+
+
+def write_state(path, acc_dir, checked):
+    files = {}
+    for name, lines in checked.items():
+        stat = (acc_dir / name).stat()
+        files[name] = {'json_mtime': stat.st_mtime_ns, 'json_size': stat.st_size, 'checked': lines}
+    path.write_text(json.dumps({'version': SHARD_STATE_VERSION, 'shard': 0, 'shards': 2, 'files': files}))
+    return path
+
+
+def test_merge_skips_every_claim_of_a_contested_sidecar(tmp_path):
+    for name in ('a.json', 'b.json'):
+        (tmp_path / name).write_text(json.dumps([{'labling_text': str(j)} for j in range(3)]))
+    first = write_state(tmp_path / 'first.json', tmp_path, {'a.json': [0], 'b.json': [1]})
+    second = write_state(tmp_path / 'second.json', tmp_path, {'a.json': [2]})
+
+    assert merge(tmp_path, [first, second]) == (1, 1)
+    assert len(jsonio.load(tmp_path / 'a.json')) == 3
+    assert [line['labling_text'] for line in jsonio.load(tmp_path / 'b.json')] == ['0', '2']